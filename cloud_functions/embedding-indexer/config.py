@@ -3,7 +3,18 @@ User Configuration
 """
 
 EMBEDDING_MODEL = "text-embedding-ada-002"  # Name of OpenAI embedding model
+EMBEDDING_DIMENSION = 1536  # Dimension of EMBEDDING_MODEL vectors
 PINECONE_INDEX_NAME = "openai-embedding-index2"  # Get in Pinecone console
+PINECONE_CREATE_INDEX = False  # Create the index on first use if it is missing
+PINECONE_CLOUD = "aws"  # Cloud to create the index in, if it doesn't exist
+PINECONE_REGION = "us-east-1"  # Region to create the index in, if it doesn't exist
 MAX_TOKENS_INPUT = 550  # Max number of tokens from input before chunking
 TOKEN_CHUNK_SIZE = 450  # Number of tokens to chunk if input is too long
+MAX_TOKENS_PER_EMBEDDING_REQUEST = 8191  # Max tokens in one embedding request
+MAX_ITEMS_PER_EMBEDDING_REQUEST = 2048  # Max texts in one embedding request
+EMBEDDING_QUEUE_MAX_WAIT = 0.1  # Seconds to wait for a shared embedding batch to fill
 BUCKET_PATH = "gs://[BUCKET]/embedding-indexer"  # bucket path to backup vector
+UPSERT_BATCH_SIZE = 100  # Number of vectors per Pinecone upsert request
+BATCH_COMPLETION_WINDOW = "24h"  # Completion window for OpenAI batch backfills
+BATCH_MAX_REQUESTS = 50000  # Max requests in one OpenAI batch
+BATCH_UPSERT_FLUSH_SIZE = 1000  # Vectors to hold in memory when collecting a batch
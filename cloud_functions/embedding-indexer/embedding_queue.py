@@ -0,0 +1,108 @@
+"""
+Process-wide queue to coalesce embedding requests.
+
+Cloud Functions (2nd gen) can serve several Pub/Sub messages concurrently on one
+instance. Each message usually holds only a few chunks, so embedding each message
+separately pays a full request round-trip for very little work. This queue collects
+chunks from all in-flight invocations and embeds them together, flushing when the
+oldest chunk has waited `max_wait` seconds or the token/item budget is full.
+"""
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+Chunk = Dict[str, Any]
+EmbedFn = Callable[[List[Chunk]], List[Tuple[Chunk, List[float]]]]
+
+
+class EmbeddingQueue:
+    """
+    Queue of chunks waiting to be embedded by a background thread.
+
+    Args:
+        embed_fn: Function that embeds a batch of chunks and returns
+            (chunk, embedding) tuples for the ones that succeeded.
+        max_tokens: Maximum total number of tokens per batch.
+        max_items: Maximum number of chunks per batch.
+        max_wait: Maximum number of seconds a chunk waits for a batch to fill.
+    """
+
+    def __init__(
+        self, embed_fn: EmbedFn, max_tokens: int, max_items: int, max_wait: float
+    ):
+        self._embed_fn = embed_fn
+        self._max_tokens = max_tokens
+        self._max_items = max_items
+        self._max_wait = max_wait
+        self._pending: List[Tuple[Chunk, Future, float]] = list()
+        self._pending_tokens = 0
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, chunk: Chunk) -> "Future[Optional[List[float]]]":
+        """
+        Add a chunk to the queue.
+
+        Args:
+            chunk: Dict with "text" and "n_tokens" keys.
+
+        Returns:
+            future: Resolves to the embedding, or None if the chunk could not
+                be embedded.
+        """
+        future = Future()
+        with self._cond:
+            self._pending.append((chunk, future, time.monotonic()))
+            self._pending_tokens += chunk["n_tokens"]
+            self._cond.notify()
+        return future
+
+    def _is_full(self) -> bool:
+        return (
+            self._pending_tokens >= self._max_tokens
+            or len(self._pending) >= self._max_items
+        )
+
+    def _take_batch(self) -> List[Tuple[Chunk, Future, float]]:
+        """
+        Pop the oldest pending chunks that fit in one batch. Always takes at least
+        one chunk. Must be called with the lock held.
+        """
+        batch = list()
+        batch_tokens = 0
+        while self._pending and len(batch) < self._max_items:
+            n_tokens = self._pending[0][0]["n_tokens"]
+            if batch and batch_tokens + n_tokens > self._max_tokens:
+                break
+            batch.append(self._pending.pop(0))
+            batch_tokens += n_tokens
+        self._pending_tokens -= batch_tokens
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                # Give other invocations a chance to add chunks to this batch
+                while not self._is_full():
+                    remaining = self._pending[0][2] + self._max_wait - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._take_batch()
+
+            chunks = [chunk for chunk, _, _ in batch]
+            try:
+                results = self._embed_fn(chunks)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            # Match embeddings back to the chunk that requested them
+            embeddings = {id(chunk): embedding for chunk, embedding in results}
+            for chunk, future, _ in batch:
+                future.set_result(embeddings.get(id(chunk)))
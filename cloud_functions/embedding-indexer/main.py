@@ -2,18 +2,16 @@
 Cloud Function to generate embeddings from text and index them in Pinecone.
 This function is triggered by a Pub/Sub message containing contents to embed.
 
-Note: This assumes you already have the Pinecone index defined in `config.py` created.
-If you do not, run something like the following:
-
-```
-    # Create Pinecone index, if it doesn't exist. And connect.
-    if config.PINECONE_INDEX_NAME not in pc.list_indexes():
-        # See API for proper spec fo rthis now
-        pc.create_index(
-            config.PINECONE_INDEX_NAME, dimension=len(embedding_batches[0][0])
-        )
-```
+Note: The Pinecone index defined in `config.py` must already exist. Set
+`PINECONE_CREATE_INDEX` in `config.py` to instead create it as a serverless index on
+the first invocation of each instance if it's missing.
 
+For bulk backfills, `process_backfill_trigger` embeds a JSONL file of records (with
+"text" and "attributes" fields, as used by `scripts/backfill_from_file.py`) through
+the OpenAI Batch API instead. It is triggered by the file landing in a Cloud Storage
+bucket, and submits the batches. Publish each printed batch ID to the topic of
+`process_backfill_results`, deployed with retries enabled, which inserts the
+embeddings into Pinecone once the batch completes.
 
 """
 
@@ -24,10 +22,16 @@ import hashlib
 import json
 import openai
 import os
-from pinecone import Pinecone
+import tempfile
+from operator import methodcaller
+from embedding_queue import EmbeddingQueue
+from pinecone import ServerlessSpec
+from pinecone.grpc import PineconeGRPC
 from smart_open import open
+import threading
 import time
-from tokenization import tiktoken_len, split_by_tokenization
+from tokenization import tokenize, split_by_tokens
+from typing import Any, Dict, Iterator, List, Sequence, Tuple
 
 """
 Initialization
@@ -37,12 +41,301 @@ Initialization
 API_KEY_OPENAI = os.environ["API_KEY_OPENAI"]
 API_KEY_PINECONE = os.environ["API_KEY_PINECONE"]
 
+# Set to "true" to coalesce embedding requests across concurrent invocations.
+# Only useful when the function is deployed with concurrency > 1.
+EMBEDDING_QUEUE_ENABLED = (
+    os.environ.get("EMBEDDING_QUEUE_ENABLED", "").lower() == "true"
+)
+
+# Token budget per embedding request. Leave some headroom since our token counts may
+# differ slightly from the API's.
+EMBEDDING_TOKEN_BUDGET = int(0.9 * config.MAX_TOKENS_PER_EMBEDDING_REQUEST)
+
 # Initialize OpenAI
 openai.api_key = API_KEY_OPENAI
 client = openai.Client(api_key=API_KEY_OPENAI)
 
-# Initialize Pinecone
-pc = Pinecone(api_key=API_KEY_PINECONE)
+# Initialize Pinecone over gRPC. The index connection is made on first use and then
+# reused by every invocation served by this instance.
+pc = PineconeGRPC(api_key=API_KEY_PINECONE)
+_index = None
+_index_lock = threading.Lock()
+
+
+def _ensure_index() -> None:
+    """
+    Create the Pinecone index defined in `config.py` if it doesn't exist yet.
+    """
+    if config.PINECONE_INDEX_NAME in pc.list_indexes().names():
+        return
+
+    print(f"Creating Pinecone index: {config.PINECONE_INDEX_NAME}.")
+    pc.create_index(
+        config.PINECONE_INDEX_NAME,
+        dimension=config.EMBEDDING_DIMENSION,
+        spec=ServerlessSpec(cloud=config.PINECONE_CLOUD, region=config.PINECONE_REGION),
+    )
+
+
+def get_index():
+    """
+    Get the Pinecone index, connecting to it (and creating it if enabled and needed)
+    only once per instance.
+
+    Returns:
+        index: The Pinecone index
+    """
+    global _index
+    with _index_lock:
+        if _index is None:
+            if config.PINECONE_CREATE_INDEX:
+                _ensure_index()
+            _index = pc.Index(config.PINECONE_INDEX_NAME)
+    return _index
+
+
+def chunked(items: List[Any], batch_size: int) -> Iterator[List[Any]]:
+    """
+    Split a list into successive batches of batch_size.
+
+    Args:
+        items: The list to split.
+        batch_size: The maximum number of items per batch.
+
+    Returns:
+        batches: An iterator of lists with at most batch_size items each.
+    """
+    for i in range(0, len(items), batch_size):
+        yield items[i : i + batch_size]
+
+
+def get_vector_ids(texts: Sequence[str]) -> List[str]:
+    """
+    Hash each text to get a unique, deterministic vector ID. The hash must not
+    change, or re-indexed texts would be stored alongside their old vectors.
+
+    Args:
+        texts: The texts to hash.
+
+    Returns:
+        vector_ids: One 10 character hex ID per text.
+    """
+    return [
+        hashlib.shake_256(text_bytes).hexdigest(5)
+        for text_bytes in map(methodcaller("encode"), texts)
+    ]
+
+
+def batch_by_tokens(
+    chunks: List[Dict[str, Any]], max_tokens: int, max_items: int
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Group text chunks into batches that fit in a single embedding request.
+
+    Args:
+        chunks: List of chunks, each a dict with "text" and "n_tokens" keys.
+        max_tokens: Maximum total number of tokens per batch.
+        max_items: Maximum number of chunks per batch.
+
+    Returns:
+        batches: An iterator of lists of chunks.
+    """
+    batch = list()
+    batch_tokens = 0
+    for chunk in chunks:
+        if batch and (
+            batch_tokens + chunk["n_tokens"] > max_tokens or len(batch) >= max_items
+        ):
+            yield batch
+            batch = list()
+            batch_tokens = 0
+        batch.append(chunk)
+        batch_tokens += chunk["n_tokens"]
+    if batch:
+        yield batch
+
+
+def embed_batch(
+    batch: List[Dict[str, Any]]
+) -> List[Tuple[Dict[str, Any], List[float]]]:
+    """
+    Embed a batch of text chunks in a single request. If the request is rejected
+    as too large, the batch is split in half and retried. On any other error,
+    each chunk is retried on its own so only the failing chunks are skipped.
+
+    Args:
+        batch: List of chunks, each a dict with "text" and "n_tokens" keys.
+
+    Returns:
+        processed_chunks: List of (chunk, embedding) tuples for the chunks that
+            were embedded successfully.
+    """
+    try:
+        res = client.embeddings.create(
+            input=[chunk["text"] for chunk in batch], model=config.EMBEDDING_MODEL
+        )
+    except openai.BadRequestError as e:
+        if len(batch) == 1:
+            print(f"Unable to embed text chunk: {e}. Skipping.")
+            return list()
+        # Request too large: split in half and retry
+        mid = len(batch) // 2
+        return embed_batch(batch[:mid]) + embed_batch(batch[mid:])
+    except Exception as e:
+        if len(batch) == 1:
+            print(f"Unable to embed text chunk: {e}. Skipping.")
+            return list()
+        # Retry one by one so a single bad chunk doesn't drop the whole batch
+        print(f"Unable to embed batch of {len(batch)} chunks: {e}. Retrying singly.")
+        processed_chunks = list()
+        for chunk in batch:
+            processed_chunks.extend(embed_batch([chunk]))
+        return processed_chunks
+
+    embeddings = [d.embedding for d in sorted(res.data, key=lambda d: d.index)]
+    return list(zip(batch, embeddings))
+
+
+# Shared by all invocations on this instance, if enabled
+embedding_queue = None
+if EMBEDDING_QUEUE_ENABLED:
+    embedding_queue = EmbeddingQueue(
+        embed_batch,
+        max_tokens=EMBEDDING_TOKEN_BUDGET,
+        max_items=config.MAX_ITEMS_PER_EMBEDDING_REQUEST,
+        max_wait=config.EMBEDDING_QUEUE_MAX_WAIT,
+    )
+
+
+def split_text(text: str) -> List[Dict[str, Any]]:
+    """
+    Split text into chunks that each fit in an embedding request.
+
+    Args:
+        text: The text to split.
+
+    Returns:
+        chunks: List of chunks, each a dict with "text" and "n_tokens" keys.
+    """
+    # Tokenize once, both to count the tokens and to split on token boundaries
+    tokens = tokenize(text)
+    n_tokens = len(tokens)
+    print(f"Found {n_tokens} tokens in input text.")
+
+    # Make sure every chunk fits in an embedding request up front, so requests are
+    # not rejected and split/retried in embed_batch
+    max_tokens_input = min(config.MAX_TOKENS_INPUT, EMBEDDING_TOKEN_BUDGET)
+    token_chunk_size = min(config.TOKEN_CHUNK_SIZE, EMBEDDING_TOKEN_BUDGET)
+
+    chunks = [{"text": text, "n_tokens": n_tokens}]
+    if n_tokens > max_tokens_input:
+        # Split into chunks on token boundaries
+        chunks = split_by_tokens(text, token_chunk_size, tokens=tokens)
+        print(
+            f"Split into {len(chunks)} chunks of text. Chunk sizes: "
+            f"[{[s['n_tokens'] for s in chunks]}]"
+        )
+    return chunks
+
+
+def build_vectors(
+    processed_chunks: List[Tuple[Dict[str, Any], Any]], attributes: Dict[str, str]
+) -> List[Tuple[str, Any, Dict[str, Any]]]:
+    """
+    Build Pinecone vectors from embedded chunks and the attributes of their source.
+
+    Args:
+        processed_chunks: List of (chunk, embedding) tuples.
+        attributes: Attributes of the source text. Must contain a "title" key.
+            Values are stored as strings.
+
+    Returns:
+        vectors: List of (vector_id, embedding, metadata) tuples.
+    """
+    # Hash the texts to get unique vector IDs
+    vector_ids = get_vector_ids([data["text"] for data, _ in processed_chunks])
+
+    # Attributes that came from the source are shared by every chunk
+    base_metadata = {k: str(v) for k, v in attributes.items()}
+    base_title = base_metadata.pop("title")
+
+    # Create vector objects, adding an incrementor to the title
+    vectors = list()
+    for i, (vector_id, cur_record) in enumerate(zip(vector_ids, processed_chunks), 1):
+        data, embedding = cur_record
+        metadata = {
+            "text": data["text"],
+            "n_tokens": str(data["n_tokens"]),
+            **base_metadata,
+            "title": f"{base_title} - {i:03d}",
+        }
+        vectors.append((vector_id, embedding, metadata))
+    return vectors
+
+
+def upsert_vectors(vectors: List[Tuple[str, Any, Dict[str, Any]]]) -> int:
+    """
+    Upsert vectors into the Pinecone index in batches of UPSERT_BATCH_SIZE.
+
+    Args:
+        vectors: List of (vector_id, embedding, metadata) tuples.
+
+    Returns:
+        processed_vector_cnt: Number of vectors upserted successfully.
+    """
+    # The requests are multiplexed over the index's gRPC channel.
+    index = get_index()
+    upsert_futures = [
+        (batch, index.upsert(vectors=batch, async_req=True))
+        for batch in chunked(vectors, config.UPSERT_BATCH_SIZE)
+    ]
+    processed_vector_cnt = 0
+    for batch, upsert_future in upsert_futures:
+        try:
+            upsert_future.result()
+        except Exception as e:
+            print(f"Unable to upsert batch of {len(batch)} vectors: {e}. Skipping")
+            continue
+        processed_vector_cnt += len(batch)
+    print(
+        f"Inserted {processed_vector_cnt} of {len(vectors)} candidate vectors "
+        f"into Pinecone index: {config.PINECONE_INDEX_NAME}."
+    )
+    return processed_vector_cnt
+
+
+def backup_vectors(vectors: List[Tuple[str, Any, Dict[str, Any]]]) -> None:
+    """
+    Save vectors to GCS as a single JSONL for backup purposes. Does nothing if
+    BUCKET_PATH is not set.
+
+    Args:
+        vectors: List of (vector_id, embedding, metadata) tuples.
+    """
+    if not config.BUCKET_PATH or not vectors:
+        return
+
+    vector_filename = f"vector_{vectors[0][0]}_{int(time.time())}.jsonl"
+    bucket_path = f"{config.BUCKET_PATH}/{vector_filename}"
+    with open(bucket_path, "w") as f:
+        for vector_id, embedding, metadata in vectors:
+            # create a JSON line with the vector ID, embedding, and metadata
+            record = {"id": vector_id, "embedding": embedding, "metadata": metadata}
+            f.write(json.dumps(record))
+            f.write("\n")
+
+
+def get_manifest_path(input_file_id: str) -> str:
+    """
+    Get the GCS path of the metadata saved for an OpenAI batch input file.
+
+    Args:
+        input_file_id: The ID of the uploaded batch input file.
+
+    Returns:
+        manifest_path: The GCS path of the manifest JSONL.
+    """
+    return f"{config.BUCKET_PATH}/batches/{input_file_id}.jsonl"
 
 
 # Triggered from a message on a Cloud Pub/Sub topic.
@@ -56,90 +349,142 @@ def process_pubsub(cloud_event):
         msg_attributes["title"] = "None"
 
     print(f"Received message with attributes: {msg_attributes}")
-    msg_token_len = tiktoken_len(msg_text)
-    print(f"Found {msg_token_len} tokens in input text.")
     print(f"Text chunk: {msg_text[:300]}")
+    chunks = split_text(msg_text)
 
-    chunks = [{"text": msg_text, "n_tokens": msg_token_len}]
-    if msg_token_len > config.MAX_TOKENS_INPUT:
-        # Split into chunks based on tokenization
-        chunks = split_by_tokenization(msg_text, config.TOKEN_CHUNK_SIZE)
-        print(
-            f"Split into {len(chunks)} chunks of text. Chunk sizes: "
-            f"[{[s['n_tokens'] for s in chunks]}]"
-        )
-
-    # Run embedding one by one just in case there is an error we can catch
+    # Embed in as few requests as possible
     processed_chunks = list()
-    for i, chunk in enumerate(chunks, 1):
-        text = chunk["text"]
-        error_str = None
-        res = list()
-
-        try:
-            res = client.embeddings.create(input=text, model=config.EMBEDDING_MODEL)
-        except Exception as e:
-            error_str = str(e)
-
-        if len(res.data) == 0:
-            print(f"Unable to embed text chunk #{i}: {error_str}. Skipping.")
-            continue
-
-        embedding = res.data[0].embedding
-
-        # Append to list
-        processed_chunks.append((chunk, embedding))
+    if embedding_queue:
+        futures = [(chunk, embedding_queue.submit(chunk)) for chunk in chunks]
+        for chunk, future in futures:
+            embedding = future.result()
+            if embedding is not None:
+                processed_chunks.append((chunk, embedding))
+    else:
+        for batch in batch_by_tokens(
+            chunks,
+            max_tokens=EMBEDDING_TOKEN_BUDGET,
+            max_items=config.MAX_ITEMS_PER_EMBEDDING_REQUEST,
+        ):
+            processed_chunks.extend(embed_batch(batch))
 
     print(f"Processed {len(processed_chunks)} of {len(chunks)} possible embeddings.")
 
     """
     Batch Insert into Pinecone Index
     """
+    vectors = build_vectors(processed_chunks, msg_attributes)
+    upsert_vectors(vectors)
+    backup_vectors(vectors)
 
-    # Connect to index
-    index = pc.Index(config.PINECONE_INDEX_NAME)
 
-    # Add to index in batches
-    processed_vector_cnt = 0
-    for i, cur_record in enumerate(processed_chunks, 1):
-        # Select batch
-        data, embedding = cur_record
-        text = data["text"]
-        n_tokens = data["n_tokens"]
+# Triggered when a JSONL file of records is written to a Cloud Storage bucket.
+@functions_framework.cloud_event
+def process_backfill_trigger(cloud_event):
+    # Each line of the file is a record with "text" and "attributes" fields
+    input_path = f"gs://{cloud_event.data['bucket']}/{cloud_event.data['name']}"
+    print(f"Received backfill file: {input_path}")
+    if not config.BUCKET_PATH:
+        raise ValueError("BUCKET_PATH must be set to save batch metadata.")
 
-        # Create vector objects
-        # Hash the text to get a unique vector ID
-        vector_id = hashlib.shake_256(text.encode()).hexdigest(5)
+    # Chunk every record. The embeddings are filled in when the batch completes.
+    vectors = dict()
+    with open(input_path, "r") as f:
+        for line in f:
+            record = json.loads(line)
+            attributes = dict(record["attributes"])
+            attributes.setdefault("title", "None")
+            chunks = split_text(record["text"])
+            pending = build_vectors([(chunk, None) for chunk in chunks], attributes)
+            # Identical texts share a vector ID, and batch request IDs must be unique
+            for vector_id, _, metadata in pending:
+                vectors.setdefault(vector_id, metadata)
+    print(f"Found {len(vectors)} unique chunks to embed.")
 
-        # add attributes that came from Pub/Sub
-        metadata = {"text": text, "n_tokens": str(n_tokens)}
-        metadata.update(msg_attributes)
+    # Submit in batches of at most BATCH_MAX_REQUESTS requests
+    vector_ids = list(vectors)
+    for batch_ids in chunked(vector_ids, config.BATCH_MAX_REQUESTS):
+        with tempfile.TemporaryFile("w+b") as f:
+            for vector_id in batch_ids:
+                request = {
+                    "custom_id": vector_id,
+                    "method": "POST",
+                    "url": "/v1/embeddings",
+                    "body": {
+                        "input": vectors[vector_id]["text"],
+                        "model": config.EMBEDDING_MODEL,
+                    },
+                }
+                f.write(json.dumps(request).encode("utf-8"))
+                f.write(b"\n")
+            f.seek(0)
+            input_file = client.files.create(file=("batch.jsonl", f), purpose="batch")
 
-        # Add incrementor to title
-        metadata["title"] = f"{metadata['title']} - {i:03d}"
+        # Save the metadata so the results can be matched back to it
+        with open(get_manifest_path(input_file.id), "w") as f:
+            for vector_id in batch_ids:
+                f.write(json.dumps({"id": vector_id, "metadata": vectors[vector_id]}))
+                f.write("\n")
 
-        # Create final vector object
-        vector = (vector_id, embedding, metadata)
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/embeddings",
+            completion_window=config.BATCH_COMPLETION_WINDOW,
+        )
+        print(f"Submitted batch {batch.id} with {len(batch_ids)} requests.")
 
-        # Upsert this vector
-        try:
-            index.upsert(vectors=[vector])
-        except Exception as e:
-            print(f"Unable to upsert vector {vector_id}: {e}. Skipping")
+
+# Triggered from a message on a Cloud Pub/Sub topic containing an OpenAI batch ID.
+@functions_framework.cloud_event
+def process_backfill_results(cloud_event):
+    batch_id = base64.b64decode(cloud_event.data["message"]["data"]).decode().strip()
+    batch = client.batches.retrieve(batch_id)
+    if batch.status in ("failed", "expired", "cancelled"):
+        print(f"Batch {batch_id} ended with status {batch.status}. Skipping.")
+        return
+    if batch.status != "completed":
+        # Raise so Pub/Sub redelivers the message until the batch is done
+        raise RuntimeError(f"Batch {batch_id} is {batch.status}. Retrying later.")
+    if batch.output_file_id is None:
+        # Every request in the batch failed, so there are only errors to report
+        print(
+            f"Batch {batch_id} completed without any results. "
+            f"See error file {batch.error_file_id}. Skipping."
+        )
+        return
+
+    # Load the metadata saved when the batch was submitted
+    with open(get_manifest_path(batch.input_file_id), "r") as f:
+        metadata_by_id = dict()
+        for line in f:
+            record = json.loads(line)
+            metadata_by_id[record["id"]] = record["metadata"]
+
+    # Stream the results into Pinecone, flushing every BATCH_UPSERT_FLUSH_SIZE
+    vectors = list()
+    n_results = 0
+    n_inserted = 0
+    results = client.files.content(batch.output_file_id)
+    for line in results.iter_lines():
+        if not line:
             continue
-        processed_vector_cnt += 1
-    print(
-        f"Inserted {processed_vector_cnt} of {len(processed_chunks)} candidate vectors "
-        f"into Pinecone index: {config.PINECONE_INDEX_NAME}."
-    )
+        n_results += 1
+        result = json.loads(line)
+        response = result.get("response") or dict()
+        if response.get("status_code") != 200:
+            print(f"Unable to embed {result['custom_id']}: {result.get('error')}")
+            continue
+        embedding = response["body"]["data"][0]["embedding"]
+        vector_id = result["custom_id"]
+        vectors.append((vector_id, embedding, metadata_by_id[vector_id]))
+        if len(vectors) >= config.BATCH_UPSERT_FLUSH_SIZE:
+            n_inserted += upsert_vectors(vectors)
+            backup_vectors(vectors)
+            vectors = list()
+    if vectors:
+        n_inserted += upsert_vectors(vectors)
+        backup_vectors(vectors)
 
-    # Save vector to GCS as a single JSONL for backup purposes
-    if config.BUCKET_PATH:
-        vector_filename = f"vector_{vector_id}_{int(time.time())}.jsonl"
-        bucket_path = f"{config.BUCKET_PATH}/{vector_filename}"
-        # create a JSON line with the vector ID, embedding, and metadata
-        record = {"id": vector_id, "embedding": embedding, "metadata": metadata}
-        # Force to json as strings
-        record = json.dumps(record)
-        with open(bucket_path, "w") as f:
-            f.write(record)
+    print(f"Inserted {n_inserted} of {n_results} results from batch {batch_id}.")
+    if batch.error_file_id:
+        print(f"Some requests in batch {batch_id} failed: see {batch.error_file_id}.")
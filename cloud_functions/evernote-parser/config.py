@@ -22,3 +22,8 @@ NOTEBOOKS = [
 PUBSUB_TOPIC = "embedding-indexer"  # Pub/Sub topic to send records to
 EVERNOTE_SANDBOX = True  # Set to False for production
 EVERNOTE_CHINA = False
+MAX_WORKERS = 16  # Number of notes to fetch in parallel
+NOTEBOOKS_CACHE_TTL = 600  # Seconds to reuse the list of notebooks between runs
+NOTEBOOKS_INDEX_COLLECTION = "EvernoteNotebookIndex"  # Firestore cache of notebooks
+NOTEBOOKS_INDEX_TTL = 24 * 60 * 60  # Seconds to reuse the notebooks cached in Firestore
+NOTEBOOKS_SYNC_COLLECTION = "EvernoteNotebookSync"  # Firestore sync point per notebook
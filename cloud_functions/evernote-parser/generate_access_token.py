@@ -7,9 +7,10 @@ Ref: https://github.com/Evernote/evernote-sdk-python3/blob/master/sample/client/
 """
 
 import argparse
-import os
+import webbrowser
 
 from evernote.api.client import EvernoteClient
+from urllib.parse import parse_qs, urlparse
 
 
 def get_evernote_access_token(
@@ -73,7 +74,7 @@ def get_evernote_access_token(
 
     # Open the URL in a browser
     print("Opening URL in browser: ", auth_url)
-    os.system("open " + auth_url)
+    webbrowser.open(auth_url, new=2)
 
     # Get the verifier code from the user
     print(
@@ -82,7 +83,10 @@ def get_evernote_access_token(
     print(auth_url)
     print("\n")
     validated_url = input("Please enter the full URL of the verification page: ")
-    oauth_verifier = validated_url.split("oauth_verifier=")[1].split("&")[0]
+    query = parse_qs(urlparse(validated_url.strip()).query)
+    if "oauth_verifier" not in query:
+        raise ValueError(f"No oauth_verifier found in URL: {validated_url}")
+    oauth_verifier = query["oauth_verifier"][0]
 
     """
     Retrieve Access Token
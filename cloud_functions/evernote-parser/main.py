@@ -9,68 +9,280 @@ import config
 import evernote.edam.notestore.ttypes as NoteStoreTypes
 import evernote.edam.type.ttypes as EvernoteTypes
 import functions_framework
-import json
+import hashlib
+import orjson
 import os
+import threading
+import time
 
+from concurrent.futures import ALL_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
+from functools import lru_cache
 from evernote.api.client import EvernoteClient
 from evernote.edam.notestore import NoteStore
 from google.cloud import firestore
 from google.cloud import pubsub_v1
-from retry import retry
-from typing import Any, Dict, List, Optional, Sequence, Tuple
+from retry.api import retry_call
+from typing import (
+    AbstractSet,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 from util import clean_text
 
 
-# Get env vars
-ACCESS_TOKEN_EVERNOTE = os.environ["ACCESS_TOKEN_EVERNOTE"]
-PROJECT_ID = os.environ["PROJECT_ID"]
-
 # Static Defaults
 DEFAULT_RETRY_BACKOFF = 2
 DEFAULT_RETRY_DELAY = 1
 DEFAULT_RETRY_TRIES = 5
+FIRESTORE_BATCH_SIZE = 500  # Maximum number of writes in one Firestore batch
+
+# Batch published messages into fewer requests
+PUBLISH_BATCH_SETTINGS = pubsub_v1.types.BatchSettings(
+    max_messages=100, max_bytes=1024 * 1024, max_latency=0.05
+)
 
+# The Evernote Thrift client is not thread-safe, so each worker thread gets its own
+_thread_local = threading.local()
 
-def check_doc_exists(
-    doc_name: str, collection_name: str, client: firestore.Client
-) -> Tuple[bool, firestore.DocumentReference]:
+# Notebooks listed per (access token, sandbox, china), with the time they were listed
+_notebooks_cache: Dict[Tuple[str, bool, bool], Tuple[float, List[Any]]] = dict()
+_notebooks_cache_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_env(name: str) -> str:
     """
-    Check if a document exists in Firestore.
+    Read a required environment variable. It is read on first use rather than at
+    import, and then reused.
 
     Args:
-        doc_name: The document name.
-        collection_name: The collection name.
+        name: The name of the environment variable.
+
+    Returns:
+        value: The value of the environment variable.
+    """
+    return os.environ[name]
+
+
+@lru_cache(maxsize=None)
+def get_firestore_client() -> firestore.Client:
+    """
+    Get the Firestore client. It is created on first use and reused by every
+    invocation served by this instance.
+
+    Returns:
         client: The Firestore client.
+    """
+    return firestore.Client()
+
+
+@lru_cache(maxsize=None)
+def get_publisher() -> pubsub_v1.PublisherClient:
+    """
+    Get the Pub/Sub publisher. It is created on first use and reused by every
+    invocation served by this instance.
+
+    Returns:
+        publisher: The Pub/Sub publisher client.
+    """
+    return pubsub_v1.PublisherClient(batch_settings=PUBLISH_BATCH_SETTINGS)
+
+
+def call_with_retry(func: Callable[..., Any], *args: Any) -> Any:
+    """
+    Call an Evernote API method, retrying with backoff on failure. Retries are done
+    per API call, so a failure doesn't repeat the calls that already succeeded.
+
+    Args:
+        func: The API method to call.
+        *args: The arguments to call it with.
 
     Returns:
-        exists: True if the document exists.
-        doc_ref: The document reference.
+        result: The result of the call.
+    """
+    return retry_call(
+        func,
+        fargs=list(args),
+        tries=DEFAULT_RETRY_TRIES,
+        delay=DEFAULT_RETRY_DELAY,
+        backoff=DEFAULT_RETRY_BACKOFF,
+    )
+
+
+def get_thread_note_store(evernote_client: EvernoteClient) -> NoteStore:
     """
-    doc_ref = client.collection(collection_name).document(doc_name)
+    Get a note store of a client for the current thread, creating it on first use.
+    Threads are reused across invocations, so the store is only reused for the
+    client it was created from.
+
+    Args:
+        evernote_client: The Evernote client.
+
+    Returns:
+        note_store: The Evernote note store for this thread and client.
+    """
+    if getattr(_thread_local, "note_store_client", None) is not evernote_client:
+        _thread_local.note_store = evernote_client.get_note_store()
+        _thread_local.note_store_client = evernote_client
+    return _thread_local.note_store
+
+
+def _has_notebooks(
+    notebooks: Sequence[EvernoteTypes.Notebook], names: AbstractSet[str]
+) -> bool:
+    """Check that every lowercase name in names is one of the notebooks."""
+    return names <= {notebook.name.lower() for notebook in notebooks}
+
+
+def list_notebooks(
+    evernote_client: EvernoteClient,
+    firestore_client: firestore.Client,
+    access_token: str,
+    sandbox: bool,
+    china: bool,
+    names: AbstractSet[str] = frozenset(),
+) -> List[EvernoteTypes.Notebook]:
+    """
+    List all of the notebooks in the user's account. The slow API call is only made
+    when neither cache is fresh:
+    - in memory for NOTEBOOKS_CACHE_TTL seconds, for warm invocations
+    - the names and GUIDs in Firestore for NOTEBOOKS_INDEX_TTL seconds, for cold
+      starts
+    A cached list missing any of the requested names is refreshed.
+
+    Args:
+        evernote_client: The Evernote client.
+        firestore_client: The Firestore client.
+        access_token: The Evernote API token the client was created with.
+        sandbox: Whether the client uses the Evernote sandbox.
+        china: Whether the client uses the Evernote China API.
+        names: Lowercase names of the notebooks that are needed.
+
+    Returns:
+        notebooks: The notebooks in the user's account.
+    """
+    key = (access_token, sandbox, china)
+    with _notebooks_cache_lock:
+        cached = _notebooks_cache.get(key)
+    if (
+        cached
+        and time.monotonic() - cached[0] < config.NOTEBOOKS_CACHE_TTL
+        and _has_notebooks(cached[1], names)
+    ):
+        return cached[1]
+
+    # The token is hashed so it isn't stored in Firestore
+    doc_name = hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+    doc_ref = firestore_client.collection(config.NOTEBOOKS_INDEX_COLLECTION).document(
+        doc_name
+    )
     doc = doc_ref.get()
-    return doc.exists, doc_ref
+    notebooks = None
+    if doc.exists:
+        index = doc.to_dict()
+        if time.time() - index["listed_at"] < config.NOTEBOOKS_INDEX_TTL:
+            notebooks = [
+                EvernoteTypes.Notebook(guid=nb["guid"], name=nb["name"])
+                for nb in index["notebooks"]
+            ]
+            if not _has_notebooks(notebooks, names):
+                notebooks = None
+
+    if notebooks is None:
+        # The thread's note store may belong to another client, so use this one's
+        notebooks = call_with_retry(evernote_client.get_note_store().listNotebooks)
+        doc_ref.set(
+            {
+                "listed_at": time.time(),
+                "notebooks": [{"guid": nb.guid, "name": nb.name} for nb in notebooks],
+            }
+        )
+
+    with _notebooks_cache_lock:
+        _notebooks_cache[key] = (time.monotonic(), notebooks)
+    return notebooks
+
+
+def get_doc_name(
+    notebook: EvernoteTypes.Notebook, note: NoteStoreTypes.NoteMetadata
+) -> str:
+    """
+    Get the Firestore document name of a note.
+
+    Args:
+        notebook: The notebook the note belongs to.
+        note: The Evernote note object.
+
+    Returns:
+        doc_name: A clean document name.
+    """
+    doc_name = f"{notebook.name}-{note.title}"
+    return doc_name.replace(" ", "_").replace("/", "_")
+
+
+def get_existing_doc_names(
+    doc_names: Sequence[str], collection_name: str, client: firestore.Client
+) -> Set[str]:
+    """
+    Check which documents exist in Firestore with a single batched read.
+
+    Args:
+        doc_names: The document names.
+        collection_name: The collection name.
+        client: The Firestore client.
+
+    Returns:
+        existing: The names of the documents that exist.
+    """
+    if not doc_names:
+        return set()
+    collection = client.collection(collection_name)
+    doc_refs = [collection.document(doc_name) for doc_name in set(doc_names)]
+    return {doc.id for doc in client.get_all(doc_refs) if doc.exists}
+
+
+def save_docs(
+    docs: Dict[str, Dict[str, Any]], collection_name: str, client: firestore.Client
+) -> None:
+    """
+    Write documents to Firestore with batched writes, FIRESTORE_BATCH_SIZE at a
+    time, instead of one request per document.
+
+    Args:
+        docs: The document contents, keyed by document name.
+        collection_name: The collection name.
+        client: The Firestore client.
+    """
+    collection = client.collection(collection_name)
+    items = list(docs.items())
+    for i in range(0, len(items), FIRESTORE_BATCH_SIZE):
+        batch = client.batch()
+        for doc_name, doc in items[i : i + FIRESTORE_BATCH_SIZE]:
+            batch.set(collection.document(doc_name), doc)
+        batch.commit()
 
 
-@retry(
-    tries=DEFAULT_RETRY_TRIES, delay=DEFAULT_RETRY_DELAY, backoff=DEFAULT_RETRY_BACKOFF
-)
 def process_note(
     note: NoteStoreTypes.NoteMetadata,
     note_store: NoteStore,
-    collection_name: str,
-    client: firestore.Client,
     notebook: EvernoteTypes.Notebook,
     min_chars: int = 300,
 ) -> Optional[Dict[str, Any]]:
     """
-    Process Evernote note object with retries and returns the note content.
+    Process Evernote note object and returns the note content. Notes
+    already in Firestore should be filtered out first with get_existing_doc_names,
+    and processed notes saved afterwards with save_docs.
 
     Args:
         note: The Evernote note object.
         note_store: The Evernote note store.
-        collection_name: The Firestore collection name.
-        client: The Firestore client.
         notebook: The notebook name.
         min_chars: Minimum number of characters in a note to be considered a record
 
@@ -84,17 +296,10 @@ def process_note(
     created_time = datetime.fromtimestamp(created_time / 1000).isoformat()
 
     # Define a clean document name
-    doc_name = f"{notebook.name}-{note.title}"
-    doc_name = doc_name.replace(" ", "_").replace("/", "_")
-
-    # Check if the document name already exists in Firestore
-    doc_exists, doc_ref = check_doc_exists(doc_name, collection_name, client)
-    if doc_exists:
-        # Skip if already exists in Firestore
-        return record
+    doc_name = get_doc_name(notebook, note)
 
-    # If not, get the note content
-    note_content = note_store.getNoteContent(note.guid)
+    # Get the note content
+    note_content = call_with_retry(note_store.getNoteContent, note.guid)
     note_content = clean_text(note_content)
 
     # Build the record
@@ -117,67 +322,136 @@ def process_note(
     else:
         print(f"Skipping note {print_label} " f"because it is too short.")
 
-    # Save the record to Firestore no matter what
-    doc_ref.set({"title": doc_name})
-
     return record
 
 
-@retry(
-    tries=DEFAULT_RETRY_TRIES, delay=DEFAULT_RETRY_DELAY, backoff=DEFAULT_RETRY_BACKOFF
-)
 def process_notebook(
     notebook: EvernoteTypes.Notebook,
-    note_store: NoteStore,
+    evernote_client: EvernoteClient,
     collection_name: str,
     client: firestore.Client,
+    executor: ThreadPoolExecutor,
     limit: int = 200,
     **kwargs,
 ) -> Optional[List[Dict[str, Any]]]:
     """
-        Process Evernote note object with retries and returns the note content.
-
-        Args:
-            notebook: The notebook name.
-            note_store: The Evernote note store.
-            collection_name: The Firestore collection name.
-            client: The Firestore client.
-            limit: The number of notes to return per page.
-
-        Returns:
-            records: A list of records in the form of
-                {"text": <note_content>, "attributes": ...}
-    ):
+    Process the notes of an Evernote notebook and returns their content.
+
+    Notes are paged through from most to least recently updated. Pagination
+    stops at the notes that were already updated when the notebook was last
+    fully synced, as those have all been processed.
+
+    Args:
+        notebook: The notebook name.
+        evernote_client: The Evernote client.
+        collection_name: The Firestore collection name.
+        client: The Firestore client.
+        executor: The thread pool to process notes in parallel with.
+        limit: The number of notes to return per page.
+
+    Returns:
+        records: A list of records in the form of
+            {"text": <note_content>, "attributes": ...}
     """
-    # Paginate through the notes in the notebook, 100 at a time
-    offset = 0
+
+    def _process_note(
+        doc_name: str, note: NoteStoreTypes.NoteMetadata
+    ) -> Optional[Dict[str, Any]]:
+        note_store = get_thread_note_store(evernote_client)
+        try:
+            record = process_note(note, note_store, notebook, **kwargs)
+            # Saved to Firestore no matter what, once the whole page is processed
+            processed_docs[doc_name] = {"title": doc_name}
+            return record
+        except Exception as e:
+            # Not saved to Firestore, so it is retried on the next run
+            print(f"Error processing note {notebook.name} - {note.title}: {e}")
+            failed_notes.append(note)
+            return None
+
+    # Get the time of the most recently updated note when last fully synced
+    sync_ref = client.collection(config.NOTEBOOKS_SYNC_COLLECTION).document(
+        notebook.guid
+    )
+    sync_doc = sync_ref.get()
+    last_updated = sync_doc.to_dict()["last_updated"] if sync_doc.exists else None
+
+    # Paginate through the notes in the notebook, most recently updated first
+    note_filter = NoteStoreTypes.NoteFilter(
+        notebookGuid=notebook.guid,
+        order=EvernoteTypes.NoteSortOrder.UPDATED,
+        ascending=False,
+    )
+    result_spec = NoteStoreTypes.NotesMetadataResultSpec(
+        includeTitle=True, includeCreated=True, includeUpdated=True
+    )
+
+    def _fetch_page(offset: int) -> NoteStoreTypes.NotesMetadataList:
+        note_store = get_thread_note_store(evernote_client)
+        return call_with_retry(
+            note_store.findNotesMetadata, note_filter, offset, limit, result_spec
+        )
+
     n_notes = 0
     records = list()
-    while True:
-        note_filter = NoteStoreTypes.NoteFilter(notebookGuid=notebook.guid)
-        result_spec = NoteStoreTypes.NotesMetadataResultSpec(
-            includeTitle=True, includeCreated=True
-        )
-        note_list = note_store.findNotesMetadata(
-            note_filter, offset, limit, result_spec
-        )
+    failed_notes = list()
+    newest_updated = None
+    next_page = executor.submit(_fetch_page, 0)
+    while next_page is not None:
+        note_list = next_page.result()
         notes = note_list.notes
-        n_notes += len(notes)
+        next_page = None
 
         # If there are no more notes, break
         if not notes:
             break
+        if newest_updated is None:
+            newest_updated = notes[0].updated
+
+        # Only keep notes updated since the last sync
+        synced = False
+        if last_updated is not None:
+            n_page = len(notes)
+            notes = [note for note in notes if note.updated >= last_updated]
+            synced = len(notes) < n_page
+        n_notes += len(notes)
+
+        # Fetch the next page, if any, while the notes of this one are processed
+        offset = note_list.startIndex + len(note_list.notes)
+        if not synced and offset < note_list.totalNotes:
+            next_page = executor.submit(_fetch_page, offset)
 
         print(f"Found {n_notes} notes in {notebook.name} so far.")
+
+        # Skip notes already in Firestore, checking the whole page at once. Notes
+        # sharing a document name are only processed once.
+        notes_by_doc_name = dict()
         for note in notes:
-            record = process_note(
-                note, note_store, collection_name, client, notebook, **kwargs
-            )
+            notes_by_doc_name.setdefault(get_doc_name(notebook, note), note)
+        existing = get_existing_doc_names(
+            list(notes_by_doc_name), collection_name, client
+        )
+        new_notes = {
+            doc_name: note
+            for doc_name, note in notes_by_doc_name.items()
+            if doc_name not in existing
+        }
+
+        # Fetch the new notes of this page in parallel
+        processed_docs = dict()
+        for record in executor.map(_process_note, new_notes, new_notes.values()):
             if record:
                 records.append(record)
 
-        # Increment the offset
-        offset += limit
+        # Save the processed notes of this page to Firestore in batches
+        save_docs(processed_docs, collection_name, client)
+
+        if synced:
+            print(f"Reached notes in {notebook.name} that were already synced.")
+
+    # Only move the sync point forward if no note was skipped because of an error
+    if newest_updated is not None and not failed_notes:
+        sync_ref.set({"last_updated": newest_updated})
 
     return records
 
@@ -210,33 +484,38 @@ def scrape_evernote(
     # Init
     records = list()
     n_notebooks_found = 0
-    notebooks_to_match = [notebook.lower() for notebook in notebooks]
+    notebooks_to_match = frozenset(notebook.lower() for notebook in notebooks)
 
     # Initialize the Datastore client
-    firestore_client = firestore.Client()
+    firestore_client = get_firestore_client()
 
     # Connect to evernote
     client = EvernoteClient(token=access_token, sandbox=sandbox, china=china)
 
     # List all of the notebooks in the user's account
-    note_store = client.get_note_store()
-    notebooks_all = note_store.listNotebooks()
+    notebooks_all = list_notebooks(
+        client, firestore_client, access_token, sandbox, china, notebooks_to_match
+    )
     print(f"Found {len(notebooks_all)} notebooks.")
-    for nb in notebooks_all:
-        if nb.name.lower() not in notebooks_to_match:
-            continue
-        print(f"Processing notebook {nb.name}...")
-        n_notebooks_found += 1
-
-        notebook_records = process_notebook(
-            nb,
-            note_store,
-            config.COLLECTION_NAME,
-            firestore_client,
-            min_chars=min_chars,
-        )
-        if notebook_records:
-            records.extend(notebook_records)
+
+    # Share one thread pool across notebooks, so each thread's note store is reused
+    with ThreadPoolExecutor(max_workers=config.MAX_WORKERS) as executor:
+        for nb in notebooks_all:
+            if nb.name.lower() not in notebooks_to_match:
+                continue
+            print(f"Processing notebook {nb.name}...")
+            n_notebooks_found += 1
+
+            notebook_records = process_notebook(
+                nb,
+                client,
+                config.COLLECTION_NAME,
+                firestore_client,
+                executor,
+                min_chars=min_chars,
+            )
+            if notebook_records:
+                records.extend(notebook_records)
 
     print(
         f"Processed {n_notebooks_found} matching Evernote notebooks out of "
@@ -260,23 +539,30 @@ def process_pubsub(cloud_event):
     print(f"Received event: {cloud_event}.")
 
     # Call the function
-    records = scrape_evernote(ACCESS_TOKEN_EVERNOTE, config.NOTEBOOKS)
+    records = scrape_evernote(get_env("ACCESS_TOKEN_EVERNOTE"), config.NOTEBOOKS)
     if not records:
         print("No new records found. Exiting.")
         return
 
     # Send the records to the Pub/Sub topic
-    publisher = pubsub_v1.PublisherClient()
-    topic_path = publisher.topic_path(PROJECT_ID, config.PUBSUB_TOPIC)
+    publisher = get_publisher()
+    topic_path = publisher.topic_path(get_env("PROJECT_ID"), config.PUBSUB_TOPIC)
 
     print(f"Publishing {len(records)} records to Pub/Sub.")
+    publish_futures = list()
     for record in records:
         message = record["text"].encode("utf-8")
         attributes = record["attributes"]
         # Cast all to strings
         attributes = {k: str(v) for k, v in attributes.items()}
         # Publish the message
-        publisher.publish(topic_path, data=message, **attributes)
+        future = publisher.publish(topic_path, data=message, **attributes)
+        publish_futures.append(future)
+
+    # Wait for all the publish futures to resolve before returning
+    wait(publish_futures, return_when=ALL_COMPLETED)
+    n_failed = sum(1 for future in publish_futures if future.exception())
+    print(f"Published {len(publish_futures) - n_failed} of {len(records)} records.")
 
 
 if __name__ == "__main__":
@@ -285,12 +571,15 @@ if __name__ == "__main__":
     sandbox = config.EVERNOTE_SANDBOX
 
     # Scrape the README files of all the repositories starred by a GitHub user
-    records = scrape_evernote(ACCESS_TOKEN_EVERNOTE, config.NOTEBOOKS, sandbox=sandbox)
+    records = scrape_evernote(
+        get_env("ACCESS_TOKEN_EVERNOTE"), config.NOTEBOOKS, sandbox=sandbox
+    )
 
     # Save the records to a JSONlines file
     print(f"Saving {len(records)} records to {output_file}.")
-    with open(output_file, "w") as file:
+    with open(output_file, "wb") as file:
         # write each record as a JSON line
         for record in records:
-            file.write(json.dumps(record, default=str))
-            file.write("\n")
+            file.write(
+                orjson.dumps(record, default=str, option=orjson.OPT_APPEND_NEWLINE)
+            )
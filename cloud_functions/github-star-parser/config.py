@@ -6,3 +6,5 @@ COLLECTION_NAME = "GitHubStarredRepos"
 BRANCH_CANDIDATES = ("master", "main", "dev")
 FILE_CANDIDATES = ("README.md", "README.rst", "README.txt")
 PUBSUB_TOPIC = "url-scraper"
+MAX_WORKERS = 16  # Number of repositories to process in parallel
+PROBE_WORKERS = 32  # Number of README candidate URLs checked in parallel
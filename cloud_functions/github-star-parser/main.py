@@ -6,30 +6,258 @@ record in a JSONlines file.
 """
 import config
 import functions_framework
-import json
+import orjson
 import os
+import re
 import requests
+from concurrent.futures import ALL_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
 from google.cloud import firestore
 from google.cloud import pubsub_v1
+from requests.adapters import HTTPAdapter
 from urllib.parse import quote
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Sequence, Set
+from urllib3.util.retry import Retry
 from util import clean_text
 
-# Get env vars
-GITHUB_USERNAME = os.environ["GITHUB_USERNAME"]
-GITHUB_TOKEN = os.environ["API_KEY_GITHUB"]
-PROJECT_ID = os.environ["PROJECT_ID"]
+REQUEST_TIMEOUT = (3.05, 15)  # Connect and read timeouts in seconds
+MAX_RESPONSE_BYTES = 2 * 1024 * 1024  # Maximum size of a README to download
+FIRESTORE_BATCH_SIZE = 500  # Maximum number of writes in one Firestore batch
+
+# Batch published messages into fewer requests
+PUBLISH_BATCH_SETTINGS = pubsub_v1.types.BatchSettings(
+    max_messages=100, max_bytes=1024 * 1024, max_latency=0.05
+)
+
+# Matches the URL of the next page in a GitHub API Link header
+_NEXT_LINK_RE = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+# Reuse connections across requests. Connection errors are retried with backoff.
+session = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.5),
+)
+session.mount("https://", _adapter)
+session.mount("http://", _adapter)
+
+# One pool of threads shared by all README lookups. It bounds the total number of
+# concurrent HEAD requests instead of starting a new pool for every repository.
+_probe_executor = ThreadPoolExecutor(max_workers=config.PROBE_WORKERS)
+
+
+@lru_cache(maxsize=None)
+def get_env(name: str) -> str:
+    """
+    Read a required environment variable. It is read on first use rather than at
+    import, and then reused.
+
+    Args:
+        name: The name of the environment variable.
+
+    Returns:
+        value: The value of the environment variable.
+    """
+    return os.environ[name]
+
+
+@lru_cache(maxsize=None)
+def get_firestore_client() -> firestore.Client:
+    """
+    Get the Firestore client. It is created on first use and reused by every
+    invocation served by this instance.
+
+    Returns:
+        client: The Firestore client.
+    """
+    return firestore.Client()
+
+
+@lru_cache(maxsize=None)
+def get_publisher() -> pubsub_v1.PublisherClient:
+    """
+    Get the Pub/Sub publisher. It is created on first use and reused by every
+    invocation served by this instance.
+
+    Returns:
+        publisher: The Pub/Sub publisher client.
+    """
+    return pubsub_v1.PublisherClient(batch_settings=PUBLISH_BATCH_SETTINGS)
+
+
+def fetch_text(url: str, max_bytes: int = MAX_RESPONSE_BYTES) -> Optional[str]:
+    """
+    Download the body of a URL as text. The response is streamed so a huge README
+    is never held in memory.
+
+    Args:
+        url: The URL to download.
+        max_bytes: The maximum number of bytes to download.
+
+    Returns:
+        text: The response body, or None if the request fails, the status is not 200
+            or the body is larger than max_bytes.
+    """
+    try:
+        with session.get(url, stream=True, timeout=REQUEST_TIMEOUT) as response:
+            if response.status_code != 200:
+                print(f"Unable to fetch {url}: status {response.status_code}.")
+                return None
+            content = bytearray()
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                content.extend(chunk)
+                if len(content) > max_bytes:
+                    print(f"Skipping {url}: larger than {max_bytes} bytes.")
+                    return None
+            return content.decode(response.encoding or "utf-8", errors="replace")
+    except requests.RequestException as e:
+        print(f"Unable to fetch {url}: {e}")
+        return None
 
 
 def get_next_link(headers):
-    link_header = headers.get("Link", "")
-    links = link_header.split(", ")
-    for link in links:
-        if 'rel="next"' in link:
-            return link[link.index("<") + 1 : link.index(">")]
+    match = _NEXT_LINK_RE.search(headers.get("Link", ""))
+    return match.group(1) if match else None
+
+
+def get_doc_name(repo_url: str) -> str:
+    """
+    Get the Firestore document name of a repository: its percent-encoded URL. This
+    must stay stable, since it is how already-scraped repositories are recognised.
+
+    Args:
+        repo_url: The URL of the repository.
+
+    Returns:
+        doc_name: The document name.
+    """
+    return quote(repo_url, safe="")
+
+
+def get_existing_doc_names(
+    doc_names: Sequence[str], collection_name: str, client: firestore.Client
+) -> Set[str]:
+    """
+    Check which documents exist in Firestore with a single batched read.
+
+    Args:
+        doc_names: The document names.
+        collection_name: The collection name.
+        client: The Firestore client.
+
+    Returns:
+        existing: The names of the documents that exist.
+    """
+    if not doc_names:
+        return set()
+    collection = client.collection(collection_name)
+    doc_refs = [collection.document(doc_name) for doc_name in set(doc_names)]
+    return {doc.id for doc in client.get_all(doc_refs) if doc.exists}
+
+
+def save_docs(
+    docs: Dict[str, Dict[str, Any]], collection_name: str, client: firestore.Client
+) -> None:
+    """
+    Write documents to Firestore with batched writes, FIRESTORE_BATCH_SIZE at a
+    time, instead of one request per document.
+
+    Args:
+        docs: The document contents, keyed by document name.
+        collection_name: The collection name.
+        client: The Firestore client.
+    """
+    collection = client.collection(collection_name)
+    items = list(docs.items())
+    for i in range(0, len(items), FIRESTORE_BATCH_SIZE):
+        batch = client.batch()
+        for doc_name, doc in items[i : i + FIRESTORE_BATCH_SIZE]:
+            batch.set(collection.document(doc_name), doc)
+        batch.commit()
+
+
+def is_found(url: str) -> bool:
+    """
+    Check whether a URL exists with a HEAD request, without downloading it.
+
+    Args:
+        url: The URL to check.
+
+    Returns:
+        found: True if the URL responds with status 200.
+    """
+    try:
+        response = session.head(url, allow_redirects=False, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        print(f"Error checking {url}: {e}")
+        return False
+    return response.status_code == 200
+
+
+def find_readme_url(repo_url: str) -> Optional[str]:
+    """
+    Find the README file of a repository. All candidate branches and file names are
+    checked concurrently on the shared probe executor.
+
+    Args:
+        repo_url: The URL of the repository.
+
+    Returns:
+        readme_url: The URL of the raw README file, in order of preference of
+            BRANCH_CANDIDATES and FILE_CANDIDATES. None if no README was found.
+    """
+    base_url = repo_url.replace("github.com", "raw.githubusercontent.com")
+    candidates = [
+        f"{base_url}/{branch}/{file}"
+        for branch in config.BRANCH_CANDIDATES
+        for file in config.FILE_CANDIDATES
+    ]
+    found = list(_probe_executor.map(is_found, candidates))
+    for readme_url, readme_found in zip(candidates, found):
+        if readme_found:
+            return readme_url
     return None
 
 
+def process_repo(repo: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """
+    Scrape the README of a starred repository not yet saved in Firestore.
+
+    Args:
+        repo: The repository, as returned by the GitHub API.
+
+    Returns:
+        record: A record in the form of {"text": <readme_content>, "attributes": ...}
+            or None if the README was not found.
+    """
+    # Get the URL of the repository
+    repo_url = repo["html_url"]
+
+    # Get the URL of the README file
+    readme_url = find_readme_url(repo_url)
+    readme_content = fetch_text(readme_url) if readme_url else None
+    if readme_content is None:
+        print(f"README not found for {repo_url}. ")
+        return None
+
+    # Clean the README content
+    readme_content = clean_text(readme_content)
+
+    # Build the record
+    print(f"Saving README for {repo_url}. Snippet: {readme_content[:100]}.")
+    record = {
+        "text": readme_content,
+        "attributes": {
+            "url": repo_url,
+            "readme_url": readme_url,
+            "source": "github",
+        },
+    }
+
+    return record
+
+
 def scrape_and_save_readme(
     github_username: str, github_token: str
 ) -> List[Dict[str, Any]]:
@@ -54,7 +282,7 @@ def scrape_and_save_readme(
     records = list()
 
     # Initialize the Datastore client
-    firestore_client = firestore.Client()
+    firestore_client = get_firestore_client()
 
     # Define the GitHub API URL for fetching starred repositories
     url = f"https://api.github.com/users/{github_username}/starred"
@@ -68,63 +296,33 @@ def scrape_and_save_readme(
         print(f"Processing page {page_count}...")
 
         # Fetch starred repositories from the current page
-        response = requests.get(url, headers=headers)
+        response = session.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
         repos = response.json()
         print(f"Found {len(repos)} starred repositories on page {page_count}.")
         total_repos += len(repos)
 
-        # Iterate over each repository
-        for repo in repos:
-            # Get the URL of the repository
-            repo_url = repo["html_url"]
-
-            # Encode the URL to create a valid document name
-            doc_name = quote(repo_url, safe="")
-
-            # Check if the URL already exists in Firestore
-            doc_ref = firestore_client.collection(config.COLLECTION_NAME).document(
-                doc_name
-            )
-            doc = doc_ref.get()
-            if doc.exists:
-                # Skip if the URL already exists in Firestore
-                continue
-
-            # Get the URL of the README file
-            base_url = repo["html_url"]
-            base_url = base_url.replace("github.com", "raw.githubusercontent.com")
-
-            # Scrape the README content
-            for branch in config.BRANCH_CANDIDATES:
-                for file in config.FILE_CANDIDATES:
-                    readme_url = f"{base_url}/{branch}/{file}"
-                    readme_response = requests.get(readme_url)
-                    if readme_response.status_code == 200:
-                        break
-                if readme_response.status_code == 200:
-                    break
-            if readme_response.status_code == 200:
-                # Clean the README content
-                readme_content = readme_response.text
-                readme_content = clean_text(readme_content)
-
-                # Build the record
-                print(f"Saving README for {repo_url}. Snippet: {readme_content[:100]}.")
-                record = {
-                    "text": readme_content,
-                    "attributes": {
-                        "url": repo_url,
-                        "readme_url": readme_url,
-                        "source": "github",
-                    },
-                }
-                records.append(record)
-
-                # Add the URL to Firestore
-                doc_ref.set({"url": doc_name})
-
-            else:
-                print(f"README not found for {repo_url}. ")
+        # Check which URLs already exist in Firestore for the whole page at once.
+        doc_names = [get_doc_name(repo["html_url"]) for repo in repos]
+        existing = get_existing_doc_names(
+            doc_names, config.COLLECTION_NAME, firestore_client
+        )
+
+        # Process the new repositories in parallel
+        new_repos = {
+            doc_name: repo
+            for repo, doc_name in zip(repos, doc_names)
+            if doc_name not in existing
+        }
+        saved_docs = dict()
+        with ThreadPoolExecutor(max_workers=config.MAX_WORKERS) as executor:
+            page_records = executor.map(process_repo, new_repos.values())
+            for (doc_name, repo), record in zip(new_repos.items(), page_records):
+                if record:
+                    records.append(record)
+                    saved_docs[doc_name] = {"url": repo["html_url"]}
+
+        # Add the URLs of the page to Firestore in a single batch
+        save_docs(saved_docs, config.COLLECTION_NAME, firestore_client)
 
         # Get the URL for the next page from the Link header
         url = get_next_link(response.headers)
@@ -147,19 +345,28 @@ def process_pubsub(cloud_event):
     print(f"Received event: {cloud_event}.")
 
     # Call the function
-    records = scrape_and_save_readme(GITHUB_USERNAME, GITHUB_TOKEN)
+    records = scrape_and_save_readme(
+        get_env("GITHUB_USERNAME"), get_env("API_KEY_GITHUB")
+    )
 
     # Send the records to the Pub/Sub topic
-    publisher = pubsub_v1.PublisherClient()
-    topic_path = publisher.topic_path(PROJECT_ID, config.PUBSUB_TOPIC)
+    publisher = get_publisher()
+    topic_path = publisher.topic_path(get_env("PROJECT_ID"), config.PUBSUB_TOPIC)
 
+    publish_futures = list()
     for record in records:
         message = record["text"].encode("utf-8")
         attributes = record["attributes"]
         # Cast all to strings
         attributes = {k: str(v) for k, v in attributes.items()}
         # Publish the message
-        publisher.publish(topic_path, data=message, **attributes)
+        future = publisher.publish(topic_path, data=message, **attributes)
+        publish_futures.append(future)
+
+    # Wait for all the publish futures to resolve before returning
+    wait(publish_futures, return_when=ALL_COMPLETED)
+    n_failed = sum(1 for future in publish_futures if future.exception())
+    print(f"Published {len(publish_futures) - n_failed} of {len(records)} records.")
 
 
 # Call the function
@@ -167,12 +374,15 @@ if __name__ == "__main__":
     output_file = "github_starred_repos.jsonl"
 
     # Scrape the README files of all the repositories starred by a GitHub user
-    records = scrape_and_save_readme(GITHUB_USERNAME, GITHUB_TOKEN)
+    records = scrape_and_save_readme(
+        get_env("GITHUB_USERNAME"), get_env("API_KEY_GITHUB")
+    )
 
     # Save the records to a JSONlines file
     print(f"Saving {len(records)} records to {output_file}.")
-    with open(output_file, "w") as file:
+    with open(output_file, "wb") as file:
         # write each record as a JSON line
         for record in records:
-            file.write(json.dumps(record, default=str))
-            file.write("\n")
+            file.write(
+                orjson.dumps(record, default=str, option=orjson.OPT_APPEND_NEWLINE)
+            )
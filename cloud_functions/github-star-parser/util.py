@@ -3,6 +3,9 @@ Util functions for the GitHub Star Parser Cloud Function.
 """
 import re
 
+# A character class rather than a lazy ".*?" matches a tag without backtracking
+_TAG_RE = re.compile(r"<[^>]*>")
+
 
 def clean_text(input_text: str) -> str:
     """
@@ -16,19 +19,16 @@ def clean_text(input_text: str) -> str:
 
     """
     # Remove HTML tags
-    text = re.sub(r"<.*?>", "", input_text)
-
-    # Remove any funny characters
-    text = text.encode("ascii", "ignore").decode()
-
-    # replace any double \ with single \
-    text = text.replace("\\t", "\t").replace("\t", " ")
-    text = text.replace("\\n", "\n").replace("\n", " ")
+    text = _TAG_RE.sub("", input_text)
 
-    # Replace all duplicate spaces with single space
-    text = " ".join(text.split())
+    # Remove any funny characters. Most text is already ASCII, which is checked
+    # without copying.
+    if not text.isascii():
+        text = text.encode("ascii", "ignore").decode()
 
-    # Remove any leading or trailing spaces
-    text = text.strip()
+    # replace any escaped tabs and newlines with spaces
+    text = text.replace("\\t", " ").replace("\\n", " ").replace("\\r", " ")
 
-    return text
+    # Replace all whitespace runs with a single space. This also removes any
+    # leading or trailing spaces.
+    return " ".join(text.split())
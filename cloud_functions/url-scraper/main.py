@@ -10,13 +10,108 @@ import functions_framework
 import os
 import requests
 import sys
+from concurrent.futures import ALL_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache
 from google.cloud import pubsub_v1
+from requests.adapters import HTTPAdapter
 from tokenization import tiktoken_len
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
+from urllib3.util.retry import Retry
 from util_scrape import clean_text, get_main_text, parse_hyperlinks
 from youtube import extract_transcript_snippets_from_url, is_youtube_url
 
 MIN_TOKENS = 30
+# Maximum number of hyperlinks to scrape in parallel. Lower it with the MAX_WORKERS
+# environment variable to fit smaller memory limits.
+MAX_WORKERS = int(os.environ.get("MAX_WORKERS", 32))
+REQUEST_TIMEOUT = (3.05, 15)  # Connect and read timeouts in seconds
+MAX_RESPONSE_BYTES = 2 * 1024 * 1024  # Maximum size of a page to download
+
+# Batch published messages into fewer requests
+PUBLISH_BATCH_SETTINGS = pubsub_v1.types.BatchSettings(
+    max_messages=1000, max_bytes=1024 * 1024, max_latency=0.05
+)
+PUBLISH_TIMEOUT = 30  # Seconds to wait for all the messages to be published
+
+# Reuse connections across requests. Connection errors, rate limits and transient
+# server errors are retried with backoff. The last response is returned rather than
+# raised, so fetch_text reports its status. Each host's pool holds a connection
+# for every worker, so none are discarded when all workers fetch from one host.
+session = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        raise_on_status=False,
+    ),
+)
+session.mount("https://", _adapter)
+session.mount("http://", _adapter)
+
+
+@lru_cache(maxsize=None)
+def get_publisher() -> pubsub_v1.PublisherClient:
+    """
+    Get the Pub/Sub publisher. It is created on first use and reused by every
+    invocation served by this instance.
+
+    Returns:
+        publisher: The Pub/Sub publisher client.
+    """
+    return pubsub_v1.PublisherClient(batch_settings=PUBLISH_BATCH_SETTINGS)
+
+
+def fetch_text(url: str, max_bytes: int = MAX_RESPONSE_BYTES) -> Optional[str]:
+    """
+    Download the body of an HTML page as text. The response is streamed so a huge
+    body is never held in memory, and other content types such as PDFs or videos
+    are skipped before their body is downloaded.
+
+    Args:
+        url: The URL to download.
+        max_bytes: The maximum number of bytes to download.
+
+    Returns:
+        text: The response body, or None if the status is not 200, the content is
+            not HTML or the body is larger than max_bytes.
+    """
+    with session.get(url, stream=True, timeout=REQUEST_TIMEOUT) as response:
+        if response.status_code != 200:
+            print(f"Unable to fetch {url}: status {response.status_code}.")
+            return None
+        content_type = response.headers.get("Content-Type", "")
+        if content_type and "html" not in content_type:
+            print(f"Skipping {url}: content type {content_type}.")
+            return None
+        content_length = response.headers.get("Content-Length", "")
+        if content_length.isdigit() and int(content_length) > max_bytes:
+            print(f"Skipping {url}: larger than {max_bytes} bytes.")
+            return None
+        content = bytearray()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            content.extend(chunk)
+            if len(content) > max_bytes:
+                print(f"Skipping {url}: larger than {max_bytes} bytes.")
+                return None
+        return content.decode(response.encoding or "utf-8", errors="replace")
+
+
+def utf8_len(text: str, limit: int = MIN_TOKENS) -> int:
+    """
+    Get the UTF-8 length of a text in bytes, counted exactly only when it matters.
+
+    Args:
+        text: The text to measure.
+        limit: Texts of at least this many characters are at least this many bytes,
+            so their character count is returned without encoding them.
+
+    Returns:
+        n_bytes: The UTF-8 length, or the character count if it is at least limit.
+    """
+    return len(text) if len(text) >= limit else len(text.encode("utf-8"))
 
 
 def process_url(url: str, attributes: Dict[str, str]):
@@ -41,16 +136,17 @@ def process_url(url: str, attributes: Dict[str, str]):
         records = extract_transcript_snippets_from_url(url, min_tokens=MIN_TOKENS)
     else:
         # Otherwise, just get the main text from the URL
-        response = requests.get(url)
-        html_body = get_main_text(response.text)
-        n_tokens = 9
-        if html_body:
-            n_tokens = tiktoken_len(html_body)
-        if n_tokens >= MIN_TOKENS:
+        html = fetch_text(url)
+        # A token spans at least one UTF-8 byte, but a single character can be
+        # several tokens, so a page shorter than MIN_TOKENS bytes is skipped before
+        # it is parsed, and main text shorter than that before it is tokenized
+        if html is None or utf8_len(html) < MIN_TOKENS:
+            return None
+        html_body = get_main_text(html)
+        if utf8_len(html_body) >= MIN_TOKENS and tiktoken_len(html_body) >= MIN_TOKENS:
             # If the text is long enough, publish it
-            # add URL to attributes
-            attributes["url"] = url
-            records = [{"text": html_body, "attributes": attributes}]
+            # add URL to a copy of the attributes, which are shared across links
+            records = [{"text": html_body, "attributes": {**attributes, "url": url}}]
 
     # If there are records, clean the text field
     if records:
@@ -70,22 +166,29 @@ def publish_records(
         records: A list of records to publish. Each record is a dictionary with
             the following keys:
             - text: The text to publish
-            - attributes: A dictionary of attributes to publish with the text
+            - attributes: A dictionary of attributes to publish with the text. The
+                values must be strings, as built by process_url.
         project_id: The project ID to publish to
         destination_topic_name: The name of the topic to publish to
 
     Returns:
         None
     """
-    publisher = pubsub_v1.PublisherClient()
+    publisher = get_publisher()
     topic_path = publisher.topic_path(project_id, destination_topic_name)
 
+    publish_futures = list()
     for record in records:
         message = record["text"].encode("utf-8")
-        attributes = record["attributes"]
-        # Cast all to strings
-        attributes = {k: str(v) for k, v in attributes.items()}
-        publisher.publish(topic_path, data=message, **attributes)
+        future = publisher.publish(topic_path, data=message, **record["attributes"])
+        publish_futures.append(future)
+
+    # Wait for all the publish futures to resolve before returning
+    done, not_done = wait(
+        publish_futures, timeout=PUBLISH_TIMEOUT, return_when=ALL_COMPLETED
+    )
+    n_failed = len(not_done) + sum(1 for future in done if future.exception())
+    print(f"Published {len(publish_futures) - n_failed} of {len(records)} records.")
 
 
 # Triggered from a message on a Cloud Pub/Sub topic.
@@ -102,20 +205,24 @@ def parse_and_publish(cloud_event):
     print(f"Found {len(text)} characters in input text.")
     print(f"Text Snippet: {text[:300]}")
 
-    # Parse hyperlinks from the text
-    hyperlinks = parse_hyperlinks(text)
+    # Parse hyperlinks from the text, dropping repeats of the same link
+    hyperlinks = list(dict.fromkeys(parse_hyperlinks(text)))
     print(f"Found {len(hyperlinks)} hyperlinks in input text to scrape.")
 
-    # Process each hyperlink to generate records to publish
-    all_records = list()
-    valid_links = list()
-    for link in hyperlinks:
-        records = None
+    def _process_url(link: str) -> Optional[List[Dict[str, Any]]]:
         try:
-            records = process_url(link, attributes)
+            return process_url(link, attributes)
         except Exception as e:
             print(f"Error processing {link}: {e}", file=sys.stderr)
+            return None
 
+    # Process the hyperlinks in parallel to generate records to publish
+    all_records = list()
+    valid_links = list()
+    max_workers = max(1, min(MAX_WORKERS, len(hyperlinks)))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        link_records = list(executor.map(_process_url, hyperlinks))
+    for link, records in zip(hyperlinks, link_records):
         # Add the records to the list of records to publish
         if records and len(records) > 0:
             all_records.extend(records)
@@ -123,10 +230,12 @@ def parse_and_publish(cloud_event):
     if len(valid_links) > 0:
         # Create list of tuples with link and number of characters in the text
         print(f"Processed {len(valid_links)} valid hyperlinks: [{valid_links}]")
-        # print list of number of characters in all records
+        # print a summary of the number of characters in the records, rather than
+        # one number per record, to keep the log line short for long transcripts
+        n_chars = [len(record["text"]) for record in all_records]
         print(
             f"Number of characters in all {len(all_records)} records: "
-            f"[{[len(record['text']) for record in all_records]}]"
+            f"total {sum(n_chars)}, min {min(n_chars)}, max {max(n_chars)}."
         )
 
     # Publish the records
@@ -43,6 +43,35 @@ def test_parse_hyperlinks_with_plain_text_links():
     assert result == expected_output
 
 
+def test_parse_hyperlinks_drops_tracking_variants():
+    input_text = """
+    Read this: https://example.com/post?id=1&utm_source=newsletter
+    Shared again: https://example.com/post?id=1&utm_medium=email#comments
+    """
+
+    expected_output = [
+        "https://example.com/post?id=1",
+    ]
+
+    result = main.parse_hyperlinks(input_text)
+    assert result == expected_output
+
+
+def test_parse_hyperlinks_keeps_unparsable_urls():
+    input_text = "See [https://example.com](https://example.com) now. x http://[foo bar"
+
+    result = main.parse_hyperlinks(input_text)
+    assert "http://[foo" in result
+    assert any(link.startswith("https://example.com") for link in result)
+
+
+def test_utf8_len_counts_bytes_of_short_text():
+    # 20 CJK characters are 60 bytes, and can be more than MIN_TOKENS tokens
+    assert main.utf8_len("\u6f22" * 20) == 60
+    assert main.utf8_len("a" * 20) == 20
+    assert main.utf8_len("a" * 100) == 100
+
+
 def test_is_youtube_url():
     youtube_url = "https://www.youtube.com/watch?v=dQw4w9WgXcQ"
     non_youtube_url = "https://www.example.com"
@@ -5,19 +5,51 @@ Ref: https://github.com/pinecone-io/examples/blob/master/generation/langchain/ha
 Note that for the tokenizer we defined the encoder as "cl100k_base". This is a specific
 tiktoken encoder which is used by gpt-3.5-turbo.
 """  # noqa: E501
+import hashlib
+import os
+import threading
 import tiktoken
-from functools import partial
+from collections import OrderedDict
+from functools import lru_cache, partial
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple, Union
 
 TOKENIZER = "cl100k_base"
 
+# Keep the downloaded BPE ranks in /tmp, which persists across warm invocations of
+# the same instance. An explicitly configured cache dir takes precedence.
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", "/tmp/tiktoken-cache")
+
 # number of tokens per chunk. 4096 gpt3.5-turbo max / 2 / 5
 # Divide by 2 to split generation from context. Divide by 5 to account for 5 results
 # per query.
 CHUNK_SIZE = 375
 CHUNK_OVERLAP = 20  # number of tokens overlap between chunks to keep coherence
 
+# Token counts are cached so repeated texts (e.g. Pub/Sub retries, or the text
+# splitter measuring the same pieces) are not re-tokenized. Long texts are keyed
+# by a digest to bound the memory held by the cache.
+TOKEN_CACHE_SIZE = 4096
+TOKEN_CACHE_MAX_KEY_CHARS = 1024
+
+_token_len_cache: "OrderedDict[Tuple[str, Union[str, bytes]], int]" = OrderedDict()
+_token_len_cache_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(tokenizer: str = TOKENIZER) -> tiktoken.Encoding:
+    """
+    Get a tiktoken encoding. It is cached so the BPE ranks are only loaded once
+    per process.
+
+    Args:
+        tokenizer: Tiktoken tokenizer to use. Defaults to TOKENIZER.
+
+    Returns:
+        encoding: The tiktoken encoding
+    """
+    return tiktoken.get_encoding(tokenizer)
+
 
 def split_by_tokenization(
     text: str,
@@ -57,10 +89,10 @@ def split_by_tokenization(
     return chunks
 
 
-def tiktoken_len(text: str, tokenizer: str = TOKENIZER) -> List[str]:
+def tiktoken_len(text: str, tokenizer: str = TOKENIZER) -> int:
     """
     Tokenize a string using tiktoken and then return the
-    number of tokens
+    number of tokens. Results are cached per unique text.
 
     Args:
         text: text to tokenize
@@ -69,7 +101,54 @@ def tiktoken_len(text: str, tokenizer: str = TOKENIZER) -> List[str]:
     Returns:
         n_tokens: number of tokens
     """
-    tokenizer = tiktoken.get_encoding(TOKENIZER)
-    tokens = tokenizer.encode(text, disallowed_special=())
+    key = text
+    if len(text) > TOKEN_CACHE_MAX_KEY_CHARS:
+        key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+    key = (tokenizer, key)
+
+    with _token_len_cache_lock:
+        n_tokens = _token_len_cache.get(key)
+        if n_tokens is not None:
+            _token_len_cache.move_to_end(key)
+            return n_tokens
+
+    tokens = get_tokenizer(tokenizer).encode(text, disallowed_special=())
     n_tokens = len(tokens)
+
+    with _token_len_cache_lock:
+        _token_len_cache[key] = n_tokens
+        if len(_token_len_cache) > TOKEN_CACHE_SIZE:
+            _token_len_cache.popitem(last=False)
+
     return n_tokens
+
+
+def tiktoken_lens(texts: List[str], tokenizer: str = TOKENIZER) -> List[int]:
+    """
+    Count the tokens of many strings with a single batched call to tiktoken,
+    which encodes them in parallel outside of the GIL.
+
+    Args:
+        texts: texts to tokenize
+        tokenizer: Tiktoken tokenizer to use. Defaults to TOKENIZER.
+
+    Returns:
+        n_tokens: number of tokens of each text
+    """
+    encoded = get_tokenizer(tokenizer).encode_batch(texts, disallowed_special=())
+    return [len(tokens) for tokens in encoded]
+
+
+def _warm_tokenizer() -> None:
+    """
+    Load the default encoding so the first request doesn't pay for it. Errors are
+    ignored here and surface on first use instead.
+    """
+    try:
+        get_tokenizer(TOKENIZER)
+    except Exception as e:
+        print(f"Unable to preload tokenizer {TOKENIZER}: {e}")
+
+
+# Load the encoding in the background while the rest of the instance starts up
+threading.Thread(target=_warm_tokenizer, daemon=True).start()
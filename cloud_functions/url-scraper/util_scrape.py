@@ -3,14 +3,40 @@ utilities for url-scraper
 """
 import re
 from bs4 import BeautifulSoup
+from lxml import etree
+from lxml import html as lxml_html
 from typing import List
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 IGNORE_TERMS = ("unsubscribe", "privacy-policy", "terms", "subscribe", "contact")
+_IGNORE_TERMS_LOWER = tuple(term.lower() for term in IGNORE_TERMS)
+# Query parameters that only track where a link was shared from
+TRACKING_PARAM_PREFIXES = ("utm_",)
+# Deletes newlines, backslashes and quotes from a link
+_LINK_STRIP_TABLE = str.maketrans("", "", "\r\n\\'")
+
+# Tags holding the main text of a page.
+# Note: en-note is the evernote html export tag that sometimes has the text
+MAIN_TEXT_TAGS = ("p", "h1", "h2", "h3", "h4", "h5", "h6", "en-note")
+
+# Compiled once at import and reused by every invocation served by this instance.
+# Matches either an HTML anchor tag (href and anchor_text groups) or a plain text
+# URL (url group), so the text is scanned only once.
+_LINK_RE = re.compile(
+    r'<a [^>]*href=[\'"]?(?P<href>[^\'" >]+)[\'"]?[^>]*>(?P<anchor_text>.*?)</a>'
+    r"|(?P<url>http[s]?://"
+    r"(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+)",
+    re.DOTALL,
+)
+# A character class rather than a lazy ".*?" matches a tag without backtracking
+_TAG_RE = re.compile(r"<[^>]*>")
 
 
 def get_main_text(html: str) -> str:
     """
-    Get the main text from an HTML document.
+    Get the main text from an HTML document. The page is parsed and walked with
+    lxml, which is implemented in C. BeautifulSoup is only used if lxml cannot
+    parse the document.
 
     Args:
         html: The HTML document.
@@ -18,14 +44,15 @@ def get_main_text(html: str) -> str:
     Returns:
         main_text: The main text from the HTML document.
     """
-    soup = BeautifulSoup(html, "html.parser")
-    main_text = ""
-    # Note: en-note is the evernote html export tag that sometimes has the text
-    for tag in soup.find_all(["p", "h1", "h2", "h3", "h4", "h5", "h6", "en-note"]):
-        main_text += tag.get_text() + " "
+    try:
+        root = lxml_html.fromstring(html)
+        parts = [element.text_content() for element in root.iter(*MAIN_TEXT_TAGS)]
+    except (etree.ParserError, ValueError):
+        soup = BeautifulSoup(html, "html.parser")
+        parts = [tag.get_text() for tag in soup.find_all(MAIN_TEXT_TAGS)]
 
     # Clean it
-    main_text = main_text.strip()
+    main_text = " ".join(parts).strip()
     main_text = clean_text(main_text)
 
     return main_text
@@ -43,22 +70,19 @@ def clean_text(input_text: str) -> str:
 
     """
     # Remove HTML tags
-    text = re.sub(r"<.*?>", "", input_text)
+    text = _TAG_RE.sub("", input_text)
 
-    # Remove any funny characters
-    text = text.encode("ascii", "ignore").decode()
+    # Remove any funny characters. Most text is already ASCII, which is checked
+    # without copying.
+    if not text.isascii():
+        text = text.encode("ascii", "ignore").decode()
 
-    # replace any double \ with single \
-    text = text.replace("\\t", "\t").replace("\t", " ")
-    text = text.replace("\\n", "\n").replace("\n", " ")
+    # replace any escaped tabs and newlines with spaces
+    text = text.replace("\\t", " ").replace("\\n", " ").replace("\\r", " ")
 
-    # Replace all duplicate spaces with single space
-    text = " ".join(text.split())
-
-    # Remove any leading or trailing spaces
-    text = text.strip()
-
-    return text
+    # Replace all whitespace runs with a single space. This also removes any
+    # leading or trailing spaces.
+    return " ".join(text.split())
 
 
 def parse_hyperlinks(text: str) -> List[str]:
@@ -72,41 +96,61 @@ def parse_hyperlinks(text: str) -> List[str]:
     Returns
         links: A list of links extracted from the text.
     """
-    # Define the regex for matching URLs
-    url_regex = re.compile(
-        r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+"
-    )
-
-    # Extract all links from the text
-    html_links = re.findall(
-        r'<a [^>]*href=[\'"]?([^\'" >]+)[\'"]?[^>]*>(.*?)</a>', text
-    )
-
-    # Extract all links from the text
-    text_links = url_regex.findall(text)
-
-    # Filter out links that contain any of the ignore terms
+    # Extract all links from the text, filtering out links that contain any of the
+    # ignore terms in the link or its anchor text. Keep the first occurrence of
+    # each link.
     links = []
-    for link, text in html_links:
+    seen = set()
+    for match in _LINK_RE.finditer(text):
+        link = canonicalize_url(
+            sanitize_link(match.group("href") or match.group("url"))
+        )
+        if link in seen:
+            continue
+        link_lower = link.lower()
+        text_lower = (match.group("anchor_text") or "").lower()
         if not any(
-            term.lower() in link.lower() or term.lower() in text.lower()
-            for term in IGNORE_TERMS
+            term in link_lower or term in text_lower for term in _IGNORE_TERMS_LOWER
         ):
             links.append(link)
+            seen.add(link)
 
-    for link in text_links:
-        if link not in links and not any(
-            term.lower() in link.lower() for term in IGNORE_TERMS
-        ):
-            links.append(link)
+    return links
 
-    # strip all variants of \r and \n from each link
-    for i, link in enumerate(links):
-        link = link.replace("\r", "").replace("\n", "")
-        link = link.replace("\\r", "").replace("\\n", "")
-        link = link.replace("\\", "")
-        link = link.replace("'", "")
-        link = link.strip()
-        links[i] = link
 
-    return links
+def sanitize_link(link: str) -> str:
+    """
+    Strip all variants of \\r and \\n, backslashes and quotes from a link.
+
+    Args:
+        link: The link to sanitize.
+
+    Returns:
+        link: The sanitized link.
+    """
+    link = link.replace("\\r", "").replace("\\n", "")
+    return link.translate(_LINK_STRIP_TABLE).strip()
+
+
+def canonicalize_url(url: str) -> str:
+    """
+    Drop the fragment and tracking query parameters (see TRACKING_PARAM_PREFIXES)
+    from a URL, so variants of a link shared from different places are the same.
+
+    Args:
+        url: The URL to canonicalize.
+
+    Returns:
+        url: The canonical URL. It is returned unchanged if there is nothing to drop,
+            or if it can't be parsed as a URL.
+    """
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        # e.g. an unbalanced "[" is parsed as an invalid IPv6 host
+        return url
+    query = parse_qsl(parts.query, keep_blank_values=True)
+    kept = [(k, v) for k, v in query if not k.startswith(TRACKING_PARAM_PREFIXES)]
+    if len(kept) == len(query) and not parts.fragment:
+        return url
+    return urlunsplit(parts._replace(query=urlencode(kept), fragment=""))
@@ -1,28 +1,123 @@
 """
 YouTube utility functions
 """
+import json
 import re
 import logging
+import socket
+import urllib3
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import groupby
+from pytube import request as pytube_request
 from pytube import YouTube
 from typing import Any, Dict, List, Optional
+from urllib.error import HTTPError
 from youtube_transcript_api import YouTubeTranscriptApi
 from retry import retry
 from retry.api import retry_call
-from tokenization import split_by_tokenization, tiktoken_len, CHUNK_OVERLAP, CHUNK_SIZE
+from tokenization import (
+    split_by_tokenization,
+    tiktoken_len,
+    tiktoken_lens,
+    CHUNK_OVERLAP,
+    CHUNK_SIZE,
+)
 
 DEFAULT_RETRY_BACKOFF = 2
 DEFAULT_RETRY_DELAY = 1
 DEFAULT_RETRY_TRIES = 5
+DEFAULT_TIMEOUT = urllib3.Timeout(connect=3.05, read=15)
+
+# pytube opens a new connection with urllib for every request, and makes several
+# per video. Its requests go through this pool instead, so connections to YouTube
+# are reused across videos and warm invocations.
+_pytube_pool = urllib3.PoolManager(
+    maxsize=10, retries=urllib3.Retry(connect=0, read=0, redirect=5)
+)
 
+# Matches the 11 character video ID in watch, short link and shorts URLs
+_YT_ID_RE = re.compile(r"(?:v=|youtu\.be/|shorts/)([\w-]{11})")
 
+# Matches YouTube video URLs. Regex from https://stackoverflow.com/a/7936523
+_YT_URL_RE = re.compile(
+    r"(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})"
+)  # noqa: E501
+
+
+def _execute_pytube_request(
+    url, method=None, headers=None, data=None, timeout=socket._GLOBAL_DEFAULT_TIMEOUT
+):
+    """
+    Drop-in replacement for pytube.request._execute_request that sends the request
+    through the shared connection pool. Like urlopen, it raises HTTPError for error
+    statuses, which pytube relies on.
+    """
+    base_headers = {"User-Agent": "Mozilla/5.0", "accept-language": "en-US,en"}
+    if headers:
+        base_headers.update(headers)
+    if data and not isinstance(data, bytes):
+        data = bytes(json.dumps(data), encoding="utf-8")
+    if not url.lower().startswith("http"):
+        raise ValueError("Invalid URL")
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = DEFAULT_TIMEOUT
+
+    response = _pytube_pool.request(
+        method or ("POST" if data else "GET"),
+        url,
+        headers=base_headers,
+        body=data,
+        timeout=timeout,
+        preload_content=False,
+    )
+    if response.status >= 400:
+        response.release_conn()
+        raise HTTPError(url, response.status, response.reason, response.headers, None)
+    return response
+
+
+pytube_request._execute_request = _execute_pytube_request
+
+
+@lru_cache(maxsize=2048)
 def is_youtube_url(url):
-    # Regex from https://stackoverflow.com/a/7936523
-    youtube_pattern = re.compile(
-        r"(https?://)?(www\.)?(youtube|youtu|youtube-nocookie)\.(com|be)/(watch\?v=|embed/|v/|.+\?v=)?([^&=%\?]{11})"
-    )  # noqa: E501
+    # Every YouTube URL contains "youtu", so most other links skip the regex
+    return "youtu" in url and _YT_URL_RE.match(url)
+
 
-    return youtube_pattern.match(url)
+def parse_video_id(url: str) -> Optional[str]:
+    """
+    Parse the video ID out of a YouTube URL without fetching the page.
+
+    Args:
+        url: The URL of the YouTube video.
+
+    Returns:
+        video_id: The 11 character video ID, or None if it can't be parsed.
+    """
+    match = _YT_ID_RE.search(url)
+    return match.group(1) if match else None
+
+
+def set_chunk_durations(
+    transcript: List[Dict[str, Any]], response: List[Dict[str, Any]]
+) -> None:
+    """
+    Set the duration of each transcript chunk in place. Each chunk lasts until the
+    next one starts, and the last one until the end of the last transcript entry.
+
+    Args:
+        transcript: The transcript chunks, each with a "start" key.
+        response: The transcript entries the chunks were built from.
+    """
+    if not transcript:
+        return
+    end_time = response[-1]["start"] + response[-1]["duration"]
+    ends = [chunk["start"] for chunk in transcript[1:]] + [end_time]
+    for chunk, end in zip(transcript, ends):
+        chunk["duration"] = int(end - chunk["start"])
 
 
 def get_transcript_by_time(
@@ -52,30 +147,17 @@ def get_transcript_by_time(
         print(f"Error getting transcript for YouTube Video ID {video_id}: {e}")
         return None
 
-    # Join the transcript into chunks of chunk_size seconds.
-    # Must look at "start" of each entry in transcript and join
-    # together until the next entry is greater than chunk_size.
-    start = 0.0
-    end = chunk_size
-    text = ""
+    # Join the transcript into chunks of chunk_size seconds. Consecutive entries
+    # are grouped by the index of the chunk their "start" falls in, so boundaries
+    # don't drift and chunks with no entries are skipped over.
     transcript = list()
-    for entry in response:
-        if entry["start"] < end:
-            text += " "
-            text += entry["text"]
-        else:
-            # determine actual duration of text
-            duration = int(entry["start"] - start)
-            transcript.append({"text": text, "start": int(start), "duration": duration})
-            start = end
-            end += int(entry["start"])
-            text = entry["text"]
-    # If there is any text left over, add it to the transcript
-    if text:
-        end_time = response[-1]["start"] + response[-1]["duration"]
-        duration = int(end_time - start)
-        transcript.append({"text": text, "start": int(start), "duration": duration})
+    for chunk_idx, entries in groupby(
+        response, key=lambda entry: int(entry["start"] // chunk_size)
+    ):
+        text = " ".join(entry["text"] for entry in entries)
+        transcript.append({"text": text, "start": int(chunk_idx * chunk_size)})
 
+    set_chunk_durations(transcript, response)
     return transcript
 
 
@@ -107,40 +189,36 @@ def get_transcript_by_tokens(
         print(f"Error getting transcript for YouTube Video ID {video_id}: {e}")
         return None
 
-    # Loop through until we have enough tokens, then add to output and repeat
-    start = 0.0
-    text = ""
+    # Count the tokens of every entry with one batched call to the tokenizer. Only
+    # entries too long for a single chunk are split further.
+    pieces = list()
+    for entry, n_tokens in zip(response, tiktoken_lens([e["text"] for e in response])):
+        if n_tokens > chunk_size:
+            records = split_by_tokenization(
+                entry["text"], chunk_size=chunk_size, chunk_overlap=chunk_overlap
+            )
+            pieces.extend((r["text"], r["n_tokens"], entry["start"]) for r in records)
+        else:
+            pieces.append((entry["text"], n_tokens, entry["start"]))
+
+    # Join consecutive pieces into chunks of at most chunk_size tokens
+    parts = list()
     transcript = list()
     token_cnt = 0
-    for entry in response:
-        # Tokenize
-        records = split_by_tokenization(
-            entry["text"], chunk_size=chunk_size, chunk_overlap=chunk_overlap
-        )
-
-        # Keep adding records based on n_tokens until we have enoug
-        for record in records:
-            if token_cnt < chunk_size:
-                # When less than chunk_size, add to text and increment token_cnt
-                text += " "
-                text += record["text"]
-                token_cnt += record["n_tokens"]
-            else:
-                # When we've reached chunk_size, add to output and reset
-                duration = int(entry["start"] - start)
-                transcript.append(
-                    {"text": text, "start": int(start), "duration": duration}
-                )
-                start = start + duration
-                token_cnt = 0
-                text = record["text"]
-
-    # If there is any text left over, add it to the transcript
-    if text:
-        end_time = response[-1]["start"] + response[-1]["duration"]
-        duration = int(end_time - start)
-        transcript.append({"text": text, "start": int(start), "duration": duration})
-
+    chunk_start = 0.0
+    for text, n_tokens, start in pieces:
+        if parts and token_cnt + n_tokens > chunk_size:
+            transcript.append({"text": " ".join(parts), "start": int(chunk_start)})
+            parts = list()
+            token_cnt = 0
+        if not parts:
+            chunk_start = start
+        parts.append(text)
+        token_cnt += n_tokens
+    if parts:
+        transcript.append({"text": " ".join(parts), "start": int(chunk_start)})
+
+    set_chunk_durations(transcript, response)
     return transcript
 
 
@@ -179,6 +257,22 @@ def get_video_info(url: str) -> Optional[Dict[str, Any]]:
     return video_info
 
 
+@lru_cache(maxsize=256)
+def get_cached_video_info(url: str) -> Optional[Dict[str, Any]]:
+    """
+    Get information about a YouTube video, cached per URL so a video linked again
+    on a warm instance is not looked up twice. Failed lookups are not cached.
+    Callers must copy the returned dict before modifying it.
+
+    Args:
+        url: The URL of the YouTube video.
+
+    Returns:
+        video_info
+    """
+    return get_video_info(url)
+
+
 # Function to handle retries and errors when fetching video info
 def get_video_info_with_error_handling(video_link):
     try:
@@ -194,6 +288,7 @@ def create_snippets(
     """
     Create publishable snippets from a list of videos. Each video containts a list of
     transcript snippets. This function will create a record for each snippet.
+    Attribute values are strings, so they can be published as they are.
 
     Args:
         videos: A list of videos. Each video is a dict with at least `transcript` key.
@@ -207,28 +302,36 @@ def create_snippets(
     for video in videos:
         if not video["transcript"]:
             continue
+        # Attributes shared by every snippet of this video, cast to strings once
+        publish_date = video["publish_date"].strftime("%Y-%m-%d")
+        url_base = str(video["url"])
+        base_attributes = {
+            "source": "youtube",
+            "video_id": str(video["id"]),
+            "title": str(video["title"]),
+            "url_base": url_base,
+            "channel": str(video["channel"]),
+            "publish_date": publish_date,
+            "date": publish_date,
+        }
         # create a record for each transcript line
         for snippet in video["transcript"]:
             text = snippet["text"]
+            # A token spans at least one byte, so short snippets can be dropped
+            # without running the tokenizer
+            if min_tokens > 0 and len(text.encode("utf-8")) < min_tokens:
+                continue
             n_tokens = tiktoken_len(text)
             if n_tokens < min_tokens:
                 continue
-            publish_date = video["publish_date"].strftime("%Y-%m-%d")
             attributes = {
-                "source": "youtube",
-                "video_id": video["id"],
-                "title": video["title"],
-                "url_base": video["url"],
-                "url": f"{video['url']}&t={snippet['start']}",
+                **base_attributes,
+                "url": f"{url_base}&t={snippet['start']}",
                 "start": str(snippet["start"]),
                 "duration": str(snippet["duration"]),
-                "channel": video["channel"],
-                "publish_date": publish_date,
-                "date": publish_date,
-                "n_tokens": n_tokens,
+                "n_tokens": str(n_tokens),
             }
-            record = {"attributes": attributes, "text": text}
-            records.append(record)
+            records.append({"attributes": attributes, "text": text})
 
     return records
 
@@ -256,15 +359,26 @@ def extract_transcript_snippets_from_url(
     Returns:
         video_snippets: A list of dicts containing each transcript snippet
     """
-    video_info = get_video_info(url)
-    if not video_info:
-        logging.error(f"Error getting video info for {url}")
-        return None
+    # Fetch the video info in the background while the transcript downloads. The
+    # transcript only needs the video ID, which can usually be parsed from the URL.
+    # The info is looked up by the watch URL of the ID so it is cached per video.
+    video_id = parse_video_id(url)
+    info_url = f"https://www.youtube.com/watch?v={video_id}" if video_id else url
+    executor = ThreadPoolExecutor(max_workers=1)
+    info_future = executor.submit(get_cached_video_info, info_url)
+    executor.shutdown(wait=False)
+
+    if video_id is None:
+        video_info = info_future.result()
+        if not video_info:
+            logging.error(f"Error getting video info for {url}")
+            return None
+        video_id = video_info["id"]
 
     # Get the transcript
     try:
         transcript = get_transcript_by_tokens(
-            video_info["id"], chunk_size=chunk_size, chunk_overlap=chunk_overlap
+            video_id, chunk_size=chunk_size, chunk_overlap=chunk_overlap
         )
     except Exception as e:
         logging.error(f"Error getting transcript for {url}: {e}")
@@ -274,8 +388,13 @@ def extract_transcript_snippets_from_url(
         logging.error(f"No transcript found for {url}")
         return None
 
-    # Add the transcript to the video info
-    video_info["transcript"] = transcript
+    video_info = info_future.result()
+    if not video_info:
+        logging.error(f"Error getting video info for {url}")
+        return None
+
+    # Add the transcript to a copy of the cached video info
+    video_info = {**video_info, "transcript": transcript}
 
     # Create a record for each transcript snippet
     video_snippets = create_snippets([video_info], min_tokens=min_tokens)
@@ -18,14 +18,23 @@ Notes:
 """
 
 import argparse
+import asyncio
 import gradio as gr
 import os
 import pandas as pd
+import re
+import threading
+import tiktoken
+import time
+from collections import OrderedDict
+from functools import lru_cache
 from pinecone import Pinecone
-from typing import Any, Sequence, Tuple
+from typing import Any, List, Optional, Sequence, Tuple
 
 from llama_index.vector_stores.pinecone import PineconeVectorStore
 from llama_index.core import VectorStoreIndex
+from llama_index.core.vector_stores import ExactMatchFilter, MetadataFilters
+from llama_index.embeddings.openai import OpenAIEmbedding
 from llama_index.llms.openai import OpenAI
 
 """
@@ -41,6 +50,10 @@ PINECONE_NAMESPACE = None
 # Which language model to use. See OpenAPI docs for options
 LANGUAGE_MODEL = "gpt-4o-mini"
 
+# Embedding model used to build the index, and how many query embeddings to keep
+EMBEDDING_MODEL = "text-embedding-ada-002"
+EMBEDDING_CACHE_SIZE = 1024
+
 # Number of retrieved sources to pass in to the LLM
 TOP_K = 20
 
@@ -50,6 +63,22 @@ MAX_TEXT_PRINT = 4000
 # Flag to show sources or not
 SHOW_SOURCES = True
 
+# Seconds to reuse the answer to a repeated question, and how many answers to keep
+RESPONSE_CACHE_TTL = 6 * 60 * 60
+RESPONSE_CACHE_SIZE = 512
+
+# Most recent conversation turns, and tokens of them, to include in each query
+MAX_HISTORY_TURNS = 6
+MAX_HISTORY_TOKENS = 2000
+
+# Metadata fields a question can filter the sources on, by including e.g.
+# channel:foo or channel:"foo bar" in the question
+FILTER_KEYS = ("source", "channel")
+
+# Number of questions answered at once, and how many more can wait in the queue
+QUEUE_CONCURRENCY = 8
+QUEUE_MAX_SIZE = 64
+
 # Table headers
 TABLE_HEADERS = ("Publish Date", "Source", "Channel", "Title", "URL", "Snippet")
 
@@ -71,83 +100,316 @@ A: Answer
 INITIALIZE
 """
 
-# Get API Keys from env
-pinecone_api_key = os.environ.get("PINECONE_API_KEY")
-
-# Initialize Pinecone
-pc = Pinecone(api_key=pinecone_api_key)
-pinecone_index = pc.Index(PINECONE_INDEX_NAME)
-
-# Initialize vector store
-vector_store = PineconeVectorStore(
-    pinecone_index=pinecone_index, namespace=PINECONE_NAMESPACE
+# Matches a metadata filter in a question. The value is group 2 if quoted, else 3
+_FILTER_RE = re.compile(
+    r'\b(%s):(?:"([^"]*)"|(\S+))' % "|".join(FILTER_KEYS), re.IGNORECASE
 )
 
-# Build index from existing vector store
-index = VectorStoreIndex.from_vector_store(vector_store)
+# Answers to recent queries, keyed by the normalized query, with the time answered
+response_cache: "OrderedDict[str, Tuple[float, str, pd.DataFrame]]" = OrderedDict()
+response_cache_lock = threading.Lock()
+response_cache_stats = {"hits": 0, "misses": 0}
 
-# Create language model and bind to service context
-gpt_model = OpenAI(temperature=0, model=LANGUAGE_MODEL)
-
-# Create engine
-query_engine = index.as_query_engine(llm=gpt_model, similarity_top_k=TOP_K)
+# Embeddings of recent queries, keyed by the normalized query
+query_embedding_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+query_embedding_cache_lock = threading.Lock()
 
 """
 FUNCTIONS AND START
 """
 
 
-def ask_question(
-    message: str, history: Sequence[Any]
-) -> Tuple[str, Sequence[str], pd.DataFrame]:
+class CachedQueryEmbedding(OpenAIEmbedding):
+    """
+    OpenAI embedding model that reuses the embedding of a repeated query instead of
+    requesting it again. Queries are matched ignoring case and whitespace
     """
-    Ask a question and return the response
+
+    @staticmethod
+    def _get_cached(key: str) -> Optional[List[float]]:
+        with query_embedding_cache_lock:
+            embedding = query_embedding_cache.get(key)
+            if embedding is not None:
+                query_embedding_cache.move_to_end(key)
+            return embedding
+
+    @staticmethod
+    def _cache(key: str, embedding: List[float]) -> None:
+        with query_embedding_cache_lock:
+            query_embedding_cache[key] = embedding
+            query_embedding_cache.move_to_end(key)
+            if len(query_embedding_cache) > EMBEDDING_CACHE_SIZE:
+                query_embedding_cache.popitem(last=False)
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        key = " ".join(query.lower().split())
+        embedding = self._get_cached(key)
+        if embedding is None:
+            embedding = super()._get_query_embedding(query)
+            self._cache(key, embedding)
+        return embedding
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        key = " ".join(query.lower().split())
+        embedding = self._get_cached(key)
+        if embedding is None:
+            embedding = await super()._aget_query_embedding(query)
+            self._cache(key, embedding)
+        return embedding
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer() -> tiktoken.Encoding:
+    """
+    Get the tokenizer of the language model, used to measure the history
+
+    Returns:
+        tokenizer: The tiktoken encoding
+    """
+    try:
+        return tiktoken.encoding_for_model(LANGUAGE_MODEL)
+    except KeyError:
+        # Older tiktoken versions don't know newer models
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def trim_history(history: Sequence[Any]) -> List[str]:
+    """
+    Format the most recent turns of the history, keeping at most MAX_HISTORY_TURNS
+    turns and MAX_HISTORY_TOKENS tokens of them
 
     Args:
-        message (str): The question to ask
         history (Sequence[Any]): The history of the conversation
 
     Returns:
-        response: The formatted response
-        history: The updated history
-        source_data: The dataframe of sources
+        interactions: The formatted turns, oldest first
+    """
+    tokenizer = get_tokenizer()
+    start = max(len(history) - MAX_HISTORY_TURNS, 0)
+    interactions = list()
+    n_tokens = 0
+    for i in range(len(history) - 1, start - 1, -1):
+        msg, resp = history[i]
+        interaction = f"Interaction #{i + 1}:\nQ: {msg}\nA: {resp}\n\n"
+        n_tokens += len(tokenizer.encode(interaction, disallowed_special=()))
+        if n_tokens > MAX_HISTORY_TOKENS:
+            break
+        interactions.append(interaction)
+    interactions.reverse()
+    return interactions
+
+
+@lru_cache(maxsize=None)
+def get_index() -> VectorStoreIndex:
+    """
+    Get the vector store index. It is built on the first question rather than at
+    import, so the UI starts without waiting on Pinecone, and is reused afterwards
 
+    Returns:
+        index: The LlamaIndex vector store index
     """
-    # Build a single message to query using conversational history
-    query = ""
-    if history:
-        query = BASE_PROMPT
-        for i, (msg, resp) in enumerate(history, 1):
-            query += f"Interaction #{i}:\nQ: {msg}\nA: {resp}\n\n"
+    # Get API Keys from env
+    pinecone_api_key = os.environ.get("PINECONE_API_KEY")
+
+    # Initialize Pinecone
+    pc = Pinecone(api_key=pinecone_api_key)
+    pinecone_index = pc.Index(PINECONE_INDEX_NAME)
+
+    # Initialize vector store
+    vector_store = PineconeVectorStore(
+        pinecone_index=pinecone_index, namespace=PINECONE_NAMESPACE
+    )
+
+    # Build index from existing vector store
+    return VectorStoreIndex.from_vector_store(
+        vector_store, embed_model=CachedQueryEmbedding(model=EMBEDDING_MODEL)
+    )
+
+
+@lru_cache(maxsize=32)
+def get_query_engine(filters: Tuple[Tuple[str, str], ...] = ()) -> Any:
+    """
+    Get the query engine for a set of metadata filters. Pinecone applies the
+    filters while searching, so only matching sources are ranked
+
+    Args:
+        filters (Tuple[Tuple[str, str], ...]): (key, value) pairs the sources must
+            match exactly
+
+    Returns:
+        query_engine: The LlamaIndex query engine
+    """
+    # Create language model and bind to service context
+    gpt_model = OpenAI(temperature=0, model=LANGUAGE_MODEL)
+
+    # Create engine
+    metadata_filters = None
+    if filters:
+        metadata_filters = MetadataFilters(
+            filters=[ExactMatchFilter(key=key, value=value) for key, value in filters]
+        )
+    return get_index().as_query_engine(
+        llm=gpt_model, similarity_top_k=TOP_K, filters=metadata_filters
+    )
+
+
+def parse_filters(message: str) -> Tuple[str, Tuple[Tuple[str, str], ...]]:
+    """
+    Pull metadata filters such as channel:foo out of a question
+
+    Args:
+        message (str): The question to ask
+
+    Returns:
+        message: The question without the filters
+        filters: The sorted (key, value) filter pairs
+    """
+    filters = {
+        (match.group(1).lower(), match.group(2) or match.group(3))
+        for match in _FILTER_RE.finditer(message)
+    }
+    if not filters:
+        return message, ()
+    return " ".join(_FILTER_RE.sub("", message).split()), tuple(sorted(filters))
+
+
+def warm_up() -> None:
+    """
+    Set up the query engine, tokenizer and Pinecone and OpenAI connections before
+    the first question. Retrieving a single source warms the connections without
+    paying for an LLM call
+    """
+    try:
+        get_tokenizer()
+        get_query_engine()
+        get_index().as_retriever(similarity_top_k=1).retrieve("warm up")
+        print("Warm up complete")
+    except Exception as e:
+        print(f"Warm up failed, the first question will set up instead: {e}")
+
+
+def get_cached_response(query: str) -> Optional[Tuple[str, pd.DataFrame]]:
+    """
+    Get the cached answer to a query, if it was answered within RESPONSE_CACHE_TTL
+
+    Args:
+        query (str): The normalized query
+
+    Returns:
+        response: The cached response and source dataframe, or None on a miss
+    """
+    with response_cache_lock:
+        cached = response_cache.get(query)
+        if cached is None or time.time() - cached[0] > RESPONSE_CACHE_TTL:
+            response_cache_stats["misses"] += 1
+            return None
+        response_cache.move_to_end(query)
+        response_cache_stats["hits"] += 1
+        return cached[1], cached[2].copy()
 
-    # Add the question to the end
-    query += f"Q: {message}\nA:"
 
-    # Ask the question
-    query_response = query_engine.query(query)
+def cache_response(query: str, response: str, source_data: pd.DataFrame) -> None:
+    """
+    Cache the answer to a query, evicting the least recently used answer when full
+
+    Args:
+        query (str): The normalized query
+        response (str): The response
+        source_data (pd.DataFrame): The dataframe of sources
+    """
+    with response_cache_lock:
+        response_cache[query] = (time.time(), response, source_data.copy())
+        response_cache.move_to_end(query)
+        if len(response_cache) > RESPONSE_CACHE_SIZE:
+            response_cache.popitem(last=False)
+
+
+async def query_sources(
+    query: str, filters: Tuple[Tuple[str, str], ...] = ()
+) -> Tuple[str, pd.DataFrame]:
+    """
+    Query the engine and return the response with its sources
+
+    Args:
+        query (str): The full query, including any conversational history
+        filters (Tuple[Tuple[str, str], ...]): Metadata filters for the sources
+
+    Returns:
+        response: The formatted response
+        source_data: The dataframe of sources
+    """
+    # Build the engine off the event loop, since the first call connects to
+    # Pinecone, then ask the question without blocking other users
+    loop = asyncio.get_running_loop()
+    query_engine = await loop.run_in_executor(None, get_query_engine, filters)
+    query_response = await query_engine.aquery(query)
 
     # Parse the raw reply
     response = str(query_response)
 
-    # Extract the sources
-    source_data = pd.DataFrame(columns=TABLE_HEADERS)
-    nodes = query_response.source_nodes
-    for i, node in enumerate(nodes, 1):
+    # Extract the sources, collecting the rows first so the dataframe is built once
+    rows = list()
+    for node in query_response.source_nodes:
         # Get shortened source text
         source_text = node.node.text[2:MAX_TEXT_PRINT]
 
         # Get metadata
         metadata = node.node.extra_info
 
-        # add a row to dataframe
-        source_data.loc[i] = [
-            metadata.get("publish_date"),
-            metadata.get("source"),
-            metadata.get("channel"),
-            metadata.get("title"),
-            metadata.get("url"),
-            source_text,
-        ]
+        rows.append(
+            (
+                metadata.get("publish_date"),
+                metadata.get("source"),
+                metadata.get("channel"),
+                metadata.get("title"),
+                metadata.get("url"),
+                source_text,
+            )
+        )
+    source_data = pd.DataFrame.from_records(
+        rows, columns=TABLE_HEADERS, index=range(1, len(rows) + 1)
+    )
+
+    return response, source_data
+
+
+async def ask_question(
+    message: str, history: Sequence[Any]
+) -> Tuple[str, Sequence[str], pd.DataFrame]:
+    """
+    Ask a question and return the response
+
+    Args:
+        message (str): The question to ask
+        history (Sequence[Any]): The history of the conversation
+
+    Returns:
+        response: The formatted response
+        history: The updated history
+        source_data: The dataframe of sources
+
+    """
+    # Build a single message to query using the recent conversational history
+    query = ""
+    interactions = trim_history(history)
+    if interactions:
+        query = BASE_PROMPT + "".join(interactions)
+
+    # Add the question to the end, without any metadata filters in it
+    question, filters = parse_filters(message)
+    query += f"Q: {question}\nA:"
+    if filters:
+        print(f"Filtering sources on: {filters}")
+
+    # Reuse the answer to a repeated query, ignoring case and whitespace
+    cache_key = " ".join(query.lower().split()) + repr(filters)
+    cached = get_cached_response(cache_key)
+    if cached is not None:
+        response, source_data = cached
+    else:
+        response, source_data = await query_sources(query, filters)
+        cache_response(cache_key, response, source_data)
+    print(f"Response cache: {response_cache_stats}")
 
     # append history
     history.append((message, response))
@@ -225,5 +487,10 @@ if __name__ == "__main__":
     else:
         auth = None
 
+    # Warm up in the background while the UI starts
+    threading.Thread(target=warm_up, daemon=True).start()
+
     # Launch UI
-    ui.launch(server_name=args.address, server_port=args.port, auth=auth)
+    ui.queue(concurrency_count=QUEUE_CONCURRENCY, max_size=QUEUE_MAX_SIZE).launch(
+        server_name=args.address, server_port=args.port, auth=auth
+    )
@@ -6,18 +6,64 @@ It assumes the JSON payload is already split properly to appropriate lengths.
 """
 
 import argparse
-import json
 import logging
+import orjson
 from concurrent import futures
+from functools import lru_cache
 from google.cloud import pubsub_v1
 from tqdm import tqdm
-from typing import Any, Dict, List
+from typing import Any, Dict, Iterable, Iterator, List
+
+# Batch published messages into fewer requests
+PUBLISH_BATCH_SETTINGS = pubsub_v1.types.BatchSettings(
+    max_messages=1000, max_bytes=1024 * 1024, max_latency=0.1
+)
+
+# Block publishing while too many messages are waiting to be sent, so a large
+# backfill doesn't queue up the whole file in memory
+PUBLISH_FLOW_CONTROL = pubsub_v1.types.PublishFlowControl(
+    message_limit=10_000,
+    byte_limit=100 * 1024 * 1024,
+    limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK,
+)
+
+
+@lru_cache(maxsize=None)
+def get_publisher() -> pubsub_v1.PublisherClient:
+    """
+    Get the Pub/Sub publisher. It is created on first use and reused by every
+    later call, so the gRPC channel is only set up once.
+
+    Returns:
+        publisher: The Pub/Sub publisher client.
+    """
+    return pubsub_v1.PublisherClient(
+        batch_settings=PUBLISH_BATCH_SETTINGS,
+        publisher_options=pubsub_v1.types.PublisherOptions(
+            flow_control=PUBLISH_FLOW_CONTROL
+        ),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_topic_path(project_id: str, topic_name: str) -> str:
+    """
+    Get the full path of a Pub/Sub topic.
+
+    Args:
+        project_id: The GCP project ID.
+        topic_name: The name of the Pub/Sub topic.
+
+    Returns:
+        topic_path: The topic path.
+    """
+    return get_publisher().topic_path(project_id, topic_name)
 
 
 def publish_records(
     project_id: str,
     topic_name: str,
-    records: List[Dict[str, Any]],
+    records: Iterable[Dict[str, Any]],
 ) -> List[futures.Future]:
     """
     Publishes records to a Pub/Sub topic.
@@ -25,42 +71,57 @@ def publish_records(
     Args:
         project_id: The GCP project ID.
         topic_name: The name of the Pub/Sub topic.
-        records: A list of records to publish.
+        records: The records to publish. They are consumed as they are published, so
+            this can be a generator.
 
     Returns:
         publish_futures: A list of futures for the publish events.
 
     """
-    # Initialize a Publisher client.
-    publisher = pubsub_v1.PublisherClient()
-
-    # Define the topic path.
-    topic_path = publisher.topic_path(project_id, topic_name)
+    # Get the shared Publisher client and topic path.
+    publisher = get_publisher()
+    topic_path = get_topic_path(project_id, topic_name)
     logging.info(f"Topic path: {topic_path}")
 
     # Publish messages to the topic, extracting the main body text from the
     # HTML file
-    logging.info(f"Publishing {len(records)} records to Pub/Sub...")
-    total_processed = 0
+    logging.info("Publishing records to Pub/Sub...")
     publish_futures = list()
-    for record in tqdm(records):
-        text = record["text"]
-        attributes = record["attributes"]
-        # Cast all to strings
-        attributes = {k: str(v) for k, v in attributes.items()}
-        future = publisher.publish(topic_path, data=text.encode("utf-8"), **attributes)
-        publish_futures.append(future)
-        total_processed += 1
+    for record in tqdm(records, unit="rec"):
+        # Cast all attributes to strings
+        attributes = {k: str(v) for k, v in record["attributes"].items()}
+        publish_futures.append(
+            publisher.publish(
+                topic_path, data=record["text"].encode("utf-8"), **attributes
+            )
+        )
 
     # Wait for all the publish futures to resolve before reporting complete.
     print(f"Waiting for {len(publish_futures)} publish events to complete ...")
     futures.wait(publish_futures, return_when=futures.ALL_COMPLETED)
 
-    print(f"Done! Published {total_processed} / {len(records)} video snippets.")
+    n_published = sum(1 for future in publish_futures if not future.exception())
+    print(f"Done! Published {n_published} / {len(publish_futures)} records.")
 
     return publish_futures
 
 
+def read_records(input_file: str) -> Iterator[Dict[str, Any]]:
+    """
+    Read records from a JSONlines file one line at a time.
+
+    Args:
+        input_file: The path to the JSONlines file.
+
+    Returns:
+        records: A generator of the records in the file.
+    """
+    with open(input_file, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield orjson.loads(line)
+
+
 def main(input_file: str, project_id: str, topic_name: str):
     """
     Main function.
@@ -70,15 +131,8 @@ def main(input_file: str, project_id: str, topic_name: str):
         project_id: The GCP project ID.
         topic_name: The name of the Pub/Sub topic.
     """
-    # load all into memory via jsonlines
-    records = list()
-    with open(input_file, "r") as f:
-        for line in f:
-            record = json.loads(line)
-            records.append(record)
-
-    # publish records to pubsub
-    _ = publish_records(project_id, topic_name, records)
+    # publish records to pubsub as they are read from the file
+    _ = publish_records(project_id, topic_name, read_records(input_file))
 
 
 # Main script part
@@ -29,7 +29,7 @@ def get_links(page, link_match_text):
     """
     Get the links from the given page.
     """
-    soup = BeautifulSoup(page, "html.parser")
+    soup = BeautifulSoup(page, "lxml")
     links = soup.find_all("a", text=link_match_text)
     return links
 
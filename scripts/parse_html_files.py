@@ -9,9 +9,10 @@ import os
 import requests
 import sys
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 from tqdm import tqdm
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from uuid import uuid4
 
 # add ../cloud_functions to path to access utils
@@ -22,6 +23,27 @@ sys.path.append(
 from tokenization import tiktoken_len
 from util_scrape import get_main_text, clean_text
 
+# Maximum number of URLs to download at once
+DOWNLOAD_WORKERS = 16
+
+
+def download_html(url: str, session: requests.Session) -> str:
+    """
+    Download a URL and save it to a temporary HTML file.
+
+    Args:
+        url: The URL to download.
+        session: The requests session to download with.
+
+    Returns:
+        downloaded_file: Path of the temporary HTML file.
+    """
+    r = session.get(url)
+    downloaded_file = os.path.join("/tmp", f"temp-{str(uuid4())[0:7]}.html")
+    with open(downloaded_file, "w") as f:
+        f.write(r.text)
+    return downloaded_file
+
 
 def parse_html_input(html_path: str) -> List[str]:
     """
@@ -41,6 +63,7 @@ def parse_html_input(html_path: str) -> List[str]:
 
     # We now have a list of items where each item is either a file, directory, or URL
     files_to_parse = list()
+    urls = list()
     for h in html_path:
         # Determine if html_path is a file or directory. Cast to
         if os.path.isfile(h):
@@ -48,20 +71,26 @@ def parse_html_input(html_path: str) -> List[str]:
             files_to_parse.append(h)
         elif os.path.isdir(h):
             # If it's a HTML directory, find all HTML files.
-            for root, _, files in os.walk(h):
-                for file in files:
-                    if file.endswith(".html") or file.endswith(".htm"):
-                        files_to_parse.append(os.path.join(root, file))
+            files_to_parse.extend(
+                str(path)
+                for path in Path(h).rglob("*.htm*")
+                if path.suffix in (".html", ".htm") and path.is_file()
+            )
         # if it is a URL
         elif h.startswith("http") or h.startswith("www"):
-            # Fetch the URL and save to a temporary file.
-            r = requests.get(h)
-            downloaded_file = os.path.join("/tmp", f"temp-{str(uuid4())[0:7]}.html")
-            with open(downloaded_file, "w") as f:
-                f.write(r.text)
-            files_to_parse.append(downloaded_file)
+            # Collect URLs so they can be downloaded together below
+            urls.append(h)
         else:
             raise ValueError(f"Invalid html_path element: {h}")
+
+    # Download all URLs concurrently to temporary files, reusing connections to
+    # the same host.
+    if urls:
+        n_workers = min(len(urls), DOWNLOAD_WORKERS)
+        with requests.Session() as session, ThreadPoolExecutor(n_workers) as executor:
+            files_to_parse.extend(
+                executor.map(download_html, urls, [session] * len(urls))
+            )
     return files_to_parse
 
 
@@ -82,6 +111,31 @@ def parse_attributes(attributes_str: str) -> Dict[str, str]:
     return attributes
 
 
+def extract_text(html_path: str) -> Tuple[str, str, int]:
+    """
+    Extract and clean the main text of a local HTML file. This runs in a worker
+    process, so it must be a top-level function.
+
+    Args:
+        html_path: HTML file path.
+
+    Returns:
+        html_path: The HTML file path.
+        extracted_text: The cleaned main text.
+        n_tokens: The number of tokens in the text.
+    """
+    with open(html_path, "r") as f:
+        html = f.read()
+
+    # Extract the test
+    extracted_text = get_main_text(html)
+
+    # Clean the text
+    extracted_text = clean_text(extracted_text)
+
+    return html_path, extracted_text, tiktoken_len(extracted_text)
+
+
 def main(
     html_paths: List[str],
     output_file: str,
@@ -103,45 +157,36 @@ def main(
     if min_tokens is not None and min_tokens < 1:
         min_tokens = None
 
-    # Publish messages to the topic, extracting the main body text from the
-    # HTML file.
+    # Extract the main body text from the HTML files, parsing them in parallel
+    # across all cores. Results come back in the order of html_paths.
     records = list()
-    for tfile in tqdm(html_paths):
-        with open(tfile, "r") as f:
-            html = f.read()
-
-        # Extract the test
-        extracted_text = get_main_text(html)
-
-        # Clean the text
-        extracted_text = clean_text(extracted_text)
-
-        # If chunk_size is specified, split the text into chunks.
-        n_tokens = tiktoken_len(extracted_text)
-        if min_tokens is not None:
-            if n_tokens < min_tokens:
-                print(
-                    f"Skipping {tfile} because it has {n_tokens} tokens, which is less "
-                    f"than the minimum of {min_tokens}."
-                )
-                continue
-        print(
-            f"Extracted {len(extracted_text)} characters, or {n_tokens} "
-            f"tokens, from {tfile}."
-        )
-        print(f"Snippet:\n\t{extracted_text[0:300]}\n\n")  # Prints a sample
-
-        # Build attributes, adding the title
-        cur_attributes = attributes.copy()
-        title = Path(tfile)
-        title = title.stem
-        cur_attributes["title"] = title
-
-        record = {
-            "text": extracted_text,
-            "attributes": cur_attributes,
-        }
-        records.append(record)
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = executor.map(extract_text, html_paths, chunksize=8)
+        for tfile, extracted_text, n_tokens in tqdm(results, total=len(html_paths)):
+            if min_tokens is not None:
+                if n_tokens < min_tokens:
+                    print(
+                        f"Skipping {tfile} because it has {n_tokens} tokens, which "
+                        f"is less than the minimum of {min_tokens}."
+                    )
+                    continue
+            print(
+                f"Extracted {len(extracted_text)} characters, or {n_tokens} "
+                f"tokens, from {tfile}."
+            )
+            print(f"Snippet:\n\t{extracted_text[0:300]}\n\n")  # Prints a sample
+
+            # Build attributes, adding the title
+            cur_attributes = attributes.copy()
+            title = Path(tfile)
+            title = title.stem
+            cur_attributes["title"] = title
+
+            record = {
+                "text": extracted_text,
+                "attributes": cur_attributes,
+            }
+            records.append(record)
 
     print(f"Writing {len(records)} / {len(html_paths)} files to {output_file}")
     with jsonlines.open(output_file, "w") as writer:
@@ -20,17 +20,24 @@ Usage:
 """
 
 import argparse
-from bs4 import BeautifulSoup
 import datetime
-import json
+import diskcache
+import io
 import logging
+import orjson
 import os
 import quopri
+import re
 import sys
+import threading
+from collections import Counter
 from concurrent import futures
+from functools import lru_cache, partial
 from google.cloud import pubsub_v1
+from lxml import etree
+from lxml import html as lxml_html
 from tqdm import tqdm
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 # add ../cloud_functions to path to access youtube utils
 sys.path.append(
@@ -45,7 +52,144 @@ from youtube import (
 )
 
 # Static variables
-DEFAULT_N_THREADS = int(os.cpu_count() * 2)
+# Threads fetching videos. The work is waiting on YouTube, not on the CPU, so this
+# is not tied to the number of cores
+DEFAULT_N_THREADS = 32
+
+# Directory of the on-disk cache of video info and transcripts, so re-runs don't
+# fetch them again, and how long each is kept for in seconds
+CACHE_DIR = os.path.join(os.path.dirname(__file__), ".youtube_cache")
+VIDEO_INFO_CACHE_TTL = 24 * 60 * 60
+TRANSCRIPT_CACHE_TTL = 7 * 24 * 60 * 60
+
+# Batch published messages into fewer requests
+PUBLISH_BATCH_SETTINGS = pubsub_v1.types.BatchSettings(
+    max_messages=1000, max_bytes=1024 * 1024, max_latency=0.1
+)
+
+# Block publishing while too many messages are waiting to be sent, so publishes
+# stay bounded in memory however many snippets there are
+PUBLISH_FLOW_CONTROL = pubsub_v1.types.PublishFlowControl(
+    message_limit=10_000,
+    byte_limit=64 * 1024 * 1024,
+    limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK,
+)
+
+# Selects the link of every video title in the playlist, in a single C traversal
+VIDEO_LINK_XPATH = etree.XPath("//a[@id='video-title']/@href")
+
+# The decoded MHT is UTF-8, which lxml can't always detect from bytes on its own
+MHT_HTML_PARSER = lxml_html.HTMLParser(encoding="utf-8")
+
+
+@lru_cache(maxsize=None)
+def get_publisher() -> pubsub_v1.PublisherClient:
+    """
+    Get the Pub/Sub publisher. It is created on first use and reused by every
+    later call, so the gRPC channel is only set up once.
+
+    Returns:
+        publisher: The Pub/Sub publisher client.
+    """
+    return pubsub_v1.PublisherClient(
+        batch_settings=PUBLISH_BATCH_SETTINGS,
+        publisher_options=pubsub_v1.types.PublisherOptions(
+            flow_control=PUBLISH_FLOW_CONTROL
+        ),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_topic_path(project_id: str, topic_name: str) -> str:
+    """
+    Get the full path of a Pub/Sub topic.
+
+    Args:
+        project_id: The GCP project ID.
+        topic_name: The name of the Pub/Sub topic.
+
+    Returns:
+        topic_path: The topic path.
+    """
+    return get_publisher().topic_path(project_id, topic_name)
+
+
+def cached_call(
+    cache: Optional[diskcache.Cache],
+    key: tuple,
+    expire: float,
+    func: Callable[..., Any],
+    *args: Any,
+) -> Any:
+    """
+    Call a function, reusing its result from the cache if it is there. Failed
+    (None) results are not cached, so they are retried on the next run.
+
+    Args:
+        cache: The disk cache, or None to always call the function.
+        key: The cache key of the call.
+        expire: Seconds to keep the result for.
+        func: The function to call.
+        *args: The arguments to call the function with.
+
+    Returns:
+        result: The result of the function.
+    """
+    if cache is None:
+        return func(*args)
+    result = cache.get(key)
+    if result is None:
+        result = func(*args)
+        if result is not None:
+            cache.set(key, result, expire=expire)
+    return result
+
+
+def get_cached_video_info(
+    video_link: str, cache: Optional[diskcache.Cache]
+) -> Optional[Dict[str, Any]]:
+    """
+    Get the info of a video, from the cache if it was fetched recently.
+
+    Args:
+        video_link: The video URL.
+        cache: The disk cache, or None to not use one.
+
+    Returns:
+        video: The video info, or None if it could not be fetched.
+    """
+    return cached_call(
+        cache,
+        ("video_info", video_link),
+        VIDEO_INFO_CACHE_TTL,
+        get_video_info_with_error_handling,
+        video_link,
+    )
+
+
+def get_cached_transcript(
+    video_id: str, chunk_size: int, cache: Optional[diskcache.Cache]
+) -> Optional[List[Dict[str, Any]]]:
+    """
+    Get the transcript of a video, from the cache if it was fetched recently with
+    the same chunk size.
+
+    Args:
+        video_id: The YouTube video ID.
+        chunk_size: The number of tokens per chunk in transcript.
+        cache: The disk cache, or None to not use one.
+
+    Returns:
+        transcript: The transcript chunks, or None if it could not be fetched.
+    """
+    return cached_call(
+        cache,
+        ("transcript", video_id, chunk_size),
+        TRANSCRIPT_CACHE_TTL,
+        get_transcript_by_tokens,
+        video_id,
+        chunk_size,
+    )
 
 
 def extract_video_links_from_likes_mht(mht_file: str) -> List[str]:
@@ -58,30 +202,24 @@ def extract_video_links_from_likes_mht(mht_file: str) -> List[str]:
     Returns:
         videos: A list of video URLs
     """
-    # open the HTML file in read mode
-    with open(mht_file, "r") as file:
-        # read the contents of the file
-        html = file.read()
-
-        # Decode to get rid of spurious stuff coming from mht file
-        html = quopri.decodestring(html).decode("utf-8")
-
-    # Load the HTML file into a BeautifulSoup object
-    soup = BeautifulSoup(html, "html.parser")
+    # Decode the quoted-printable MHT file straight into a buffer of bytes, and
+    # parse those bytes without decoding them to a str first
+    with open(mht_file, "rb") as file, io.BytesIO() as html:
+        quopri.decode(file, html)
+        html.seek(0)
+        try:
+            root = lxml_html.parse(html, MHT_HTML_PARSER).getroot()
+        except etree.XMLSyntaxError as e:
+            logging.error(f"Error parsing {mht_file}: {e}")
+            root = None
 
-    link_objs = soup.find_all("a", {"id": "video-title"})
+    # Select the links of all video titles
+    hrefs = VIDEO_LINK_XPATH(root) if root is not None else list()
 
-    # parse out videos one by one
-    video_links = list()
-    for obj in link_objs:
-        try:
-            video_links.append(obj["href"].split("&")[0])
-        except Exception as e:
-            logging.error(f"Error parsing video link: {e}")
+    # Drop the playlist parameters from each link
+    video_links = [str(href).partition("&")[0] for href in hrefs]
 
-    logging.info(
-        f"Successfully parsed {len(video_links)} video URLs out of {len(link_objs)} candidates."
-    )
+    logging.info(f"Successfully parsed {len(video_links)} video URLs.")
 
     return video_links
 
@@ -103,70 +241,135 @@ def publish_video_snippets(
         publish_futures: A list of futures for the publish events.
 
     """
-    # Initialize a Publisher client.
-    publisher = pubsub_v1.PublisherClient()
-
-    # Define the topic path.
-    topic_path = publisher.topic_path(project_id, topic_name)
+    # Get the shared Publisher client and topic path.
+    publisher = get_publisher()
+    topic_path = get_topic_path(project_id, topic_name)
     logging.info(f"Topic path: {topic_path}")
 
     # Publish messages to the topic, extracting the main body text from the
     # HTML file.
     logging.info(f"Publishing {len(records)} records to Pub/Sub...")
-    total_processed = 0
+
+    # Track progress and failures as publishes complete, from the client's threads,
+    # so the loop below only hands messages to the client
+    progress = tqdm(total=len(records))
+    progress_lock = threading.Lock()
+    n_failed = 0
+
+    def _on_publish_done(future: futures.Future) -> None:
+        nonlocal n_failed
+        error = future.exception()
+        with progress_lock:
+            progress.update()
+            if error is not None:
+                n_failed += 1
+        if error is not None:
+            logging.error(f"Error publishing video snippet: {error}")
+
     publish_futures = list()
-    for record in tqdm(records):
-        text = record["text"]
-        attributes = record["attributes"]
-        future = publisher.publish(topic_path, data=text.encode("utf-8"), **attributes)
+    for record in records:
+        future = publisher.publish(
+            topic_path, data=record["text"].encode("utf-8"), **record["attributes"]
+        )
+        future.add_done_callback(_on_publish_done)
         publish_futures.append(future)
-        total_processed += 1
 
     # Wait for all the publish futures to resolve before reporting complete.
     print(f"Waiting for {len(publish_futures)} publish events to complete ...")
     futures.wait(publish_futures, return_when=futures.ALL_COMPLETED)
+    progress.close()
 
-    print(f"Done! Published {total_processed} / {len(records)} video snippets.")
+    n_published = len(publish_futures) - n_failed
+    print(f"Done! Published {n_published} / {len(records)} video snippets.")
 
     return publish_futures
 
 
-def filter_videos_by_skip_file(
-    videos: List[Dict[str, Any]], skip_file: Optional[str] = None
-) -> List[Dict[str, Any]]:
+def load_skip_pattern(skip_file: str) -> Optional["re.Pattern[str]"]:
     """
-    Filters out videos that are in the skip file.
+    Loads the keywords to skip videos by from the skip file, compiled into one
+    regular expression so every keyword is looked for in a single scan.
 
     Args:
-        videos: A list of videos.
         skip_file: The path to the CSV skip file
 
     Returns:
-        videos: A list of videos.
+        skip_pattern: Pattern matching any of the lowercase keywords, or None if the
+            file has no keywords.
     """
-    if skip_file is None:
-        logging.warning("No skip file provided. Skipping filtering.")
-        return videos
-
-    # Load the skip file
+    # Read the file in one pass, ignoring blank lines and duplicates. Longest
+    # keywords go first so the pattern is the same from run to run.
     with open(skip_file, "r") as file:
-        skip_ids = [line.strip() for line in file.readlines()]
+        skip_ids = {line.strip().lower() for line in file if line.strip()}
+    if not skip_ids:
+        return None
+    skip_ids = sorted(skip_ids, key=lambda skip_id: (-len(skip_id), skip_id))
+    return re.compile("|".join(map(re.escape, skip_ids)))
 
-    # Make all IDs lowercase
-    skip_ids = [id.lower() for id in skip_ids]
 
-    # look for any skip_id in title or channel of video
-    # the skip_id can be in any part of the title or any part of the channel
-    keep_videos = list()
-    for video in videos:
-        # check if video["title"] or video["channel"] contains any of the skip_ids
-        if any(skip_id in video["title"].lower() for skip_id in skip_ids) or any(
-            skip_id in video["channel"].lower() for skip_id in skip_ids
-        ):
-            continue
-        keep_videos.append(video)
+def is_skipped(
+    video: Dict[str, Any], skip_pattern: Optional["re.Pattern[str]"]
+) -> bool:
+    """
+    Checks whether any skip keyword is in any part of the title or channel of a
+    video.
 
-    return keep_videos
+    Args:
+        video: The video info.
+        skip_pattern: Pattern matching any of the lowercase keywords, or None to
+            skip nothing.
+
+    Returns:
+        skipped: True if the video should be skipped.
+    """
+    if skip_pattern is None:
+        return False
+    # Keywords are single lines, so none can match across the newline
+    text = f"{video['title']}\n{video['channel']}".lower()
+    return skip_pattern.search(text) is not None
+
+
+def process_video(
+    video_link: str,
+    skip_pattern: Optional["re.Pattern[str]"],
+    min_date: Optional[datetime.datetime],
+    max_date: Optional[datetime.datetime],
+    chunk_size: int,
+    cache: Optional[diskcache.Cache],
+) -> Tuple[Optional[Dict[str, Any]], str]:
+    """
+    Gets the info of a video, filters it, and gets its transcript if it passes. Doing
+    all steps per video lets transcripts download while other videos are still
+    being looked up, and no transcript is fetched for a filtered out video.
+
+    Args:
+        video_link: The video URL.
+        skip_pattern: Pattern matching the keywords to skip videos by, or None.
+        min_date: The minimum date to scrape.
+        max_date: The maximum date to scrape.
+        chunk_size: The number of tokens per chunk in transcript.
+        cache: The disk cache, or None to not use one.
+
+    Returns:
+        video: The video info with its transcript, or None if it was dropped.
+        status: Why the video was dropped, or "transcribed".
+    """
+    video = get_cached_video_info(video_link, cache)
+    if video is None:
+        return None, "no video info"
+    if is_skipped(video, skip_pattern):
+        return None, "skipped"
+    if (min_date and video["publish_date"] < min_date) or (
+        max_date and video["publish_date"] > max_date
+    ):
+        return None, "outside dates"
+
+    transcript = get_cached_transcript(video["id"], chunk_size, cache)
+    if transcript is None:
+        logging.warning(f"Transcript for {video['id']} is None.")
+        return None, "no transcript"
+    video["transcript"] = transcript
+    return video, "transcribed"
 
 
 def main(
@@ -178,6 +381,7 @@ def main(
     n_threads: int = DEFAULT_N_THREADS,
     chunk_size: int = 300,
     skip_file: Optional[str] = None,
+    use_cache: bool = True,
 ):
     """
     Main function.
@@ -192,6 +396,8 @@ def main(
         chunk_size: The number of tokens per chunk in transcript.
         skip_file: The path to CSV file, single column, listing keywords from channel
             or titles to skip (case insensitive).
+        use_cache: Whether to reuse video info and transcripts cached on disk by
+            earlier runs.
     """
     # extract videos from mht file
     logging.info(f"Extracting videos from {input_file}...")
@@ -201,67 +407,49 @@ def main(
         logging.info("None found. Exiting.")
         return
 
-    # Get video info in parallel for all videos using joblib threads
-    logging.info(f"Getting video info for {len(video_links)} video candidates...")
-    with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
-        results = executor.map(get_video_info_with_error_handling, video_links)
-
-    # Filter out any failed results and create the final list of videos
-    videos = [video for video in results if video is not None]
-    logging.info(
-        f"Successfully extracted information for {len(videos)}/{len(video_links)} videos candidates."
-    )
+    # Reuse video info and transcripts fetched by earlier runs
+    cache = diskcache.Cache(CACHE_DIR) if use_cache else None
 
-    # Filter videos that match any entry in the skip file
+    # Load the keywords to skip videos by
+    skip_pattern = None
     if skip_file:
         logging.info(f"Filtering videos that match keywords in {skip_file}...")
-        videos = filter_videos_by_skip_file(videos, skip_file)
-        logging.info(f"Found {len(videos)} videos after filtering.")
-
-    # filter out videos that don't meet date criteria
-    logging.info("Filtering videos by date...")
-    if min_date:
-        videos = [v for v in videos if min_date <= v["publish_date"]]
-    if max_date:
-        videos = [v for v in videos if v["publish_date"] <= max_date]
-    if min_date and max_date:
-        logging.info(f"Found {len(videos)} videos between {min_date} and {max_date}.")
-
-    # Transcribe, in parallel, using get_transcript_by_tokens, passing in chunk_size argument
-    logging.info(f"Transcribing {len(videos)} videos...")
-    with futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
-        transcripts = executor.map(
-            get_transcript_by_tokens,
-            [v["id"] for v in videos],
-            [chunk_size] * len(videos),
+        skip_pattern = load_skip_pattern(skip_file)
+
+    # Get the info of each video, filter it, and transcribe it, in parallel. Each
+    # video's snippets are written to the JSONlines output file as soon as it is
+    # done, so the videos and their transcripts are never all held in memory.
+    logging.info(f"Processing {len(video_links)} video candidates...")
+    outcomes = Counter()
+    n_records = 0
+    with futures.ThreadPoolExecutor(max_workers=n_threads) as executor, open(
+        output_file, "wb"
+    ) as file:
+        results = executor.map(
+            partial(
+                process_video,
+                skip_pattern=skip_pattern,
+                min_date=min_date,
+                max_date=max_date,
+                chunk_size=chunk_size,
+                cache=cache,
+            ),
+            video_links,
         )
-    logging.info("Done transcribing")
-
-    # Add transcripts to videos
-    valid_transcript_cnt = 0
-    for video, transcript in zip(videos, transcripts):
-        video["transcript"] = None
-        if transcript is None:
-            logging.warning(f"Transcript for {video['id']} is None.")
-        else:
-            video["transcript"] = transcript
-            valid_transcript_cnt += 1
-    logging.info(
-        f"Found transcripts for {valid_transcript_cnt} of {len(videos)} videos."
-    )
-    # remove videos without transcripts
-    videos = [v for v in videos if v["transcript"] is not None]
-
-    # Need to take each transcript record and create a unique publish record
-    records = create_snippets(videos, min_tokens)
-
-    # write to JSONlines output file, casting all datetime objects to strings
-    logging.info(f"Writing to {output_file}...")
-    with open(output_file, "w") as file:
-        # write each record as a JSON line
-        for record in records:
-            file.write(json.dumps(record, default=str))
-            file.write("\n")
+        for video, outcome in results:
+            outcomes[outcome] += 1
+            if video is None:
+                continue
+            # Need to take each transcript record and create a unique publish record
+            for record in create_snippets([video], min_tokens):
+                file.write(
+                    orjson.dumps(record, default=str, option=orjson.OPT_APPEND_NEWLINE)
+                )
+                n_records += 1
+    logging.info(f"Video candidates by outcome: {dict(outcomes)}")
+    logging.info(f"Wrote {n_records} snippets to {output_file}.")
+    if cache is not None:
+        cache.close()
     logging.info("Done.")
 
 
@@ -302,6 +490,17 @@ if __name__ == "__main__":
         default=None,
         help="Single column CSV file with channels and title keywords to skip",
     )
+    parser.add_argument(
+        "--n_threads",
+        type=int,
+        default=DEFAULT_N_THREADS,
+        help="Number of videos to fetch at once",
+    )
+    parser.add_argument(
+        "--no_cache",
+        action="store_true",
+        help="Fetch all video info and transcripts again, ignoring the disk cache",
+    )
 
     # cast min_date and max_date to datetime objects
     args = parser.parse_args()
@@ -318,6 +517,8 @@ if __name__ == "__main__":
         min_date=min_date,
         max_date=max_date,
         min_tokens=args.min_tokens,
+        n_threads=args.n_threads,
         chunk_size=args.chunk_size,
         skip_file=args.skip_file,
+        use_cache=not args.no_cache,
     )
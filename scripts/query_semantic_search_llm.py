@@ -107,11 +107,11 @@ if __name__ == "__main__":
 
     response = query_engine.query(query)
 
-    print("\nResponse:\n---\n")
-    print(response)
+    # Build the output as a list of lines and print it once
+    lines = ["\nResponse:\n---\n", str(response)]
 
     # Get sources
-    print("\nSources:\n---\n")
+    lines.append("\nSources:\n---\n")
     nodes = response.source_nodes
     for i, node in enumerate(nodes, 1):
         # Get shortened source text
@@ -124,9 +124,7 @@ if __name__ == "__main__":
         metadata.pop("duration", None)
 
         # pretty print
-        print(f"Source {i}:\n")
-        print(f"Text: {source_text}")
-        print("Metadata:")
-        for k, v in metadata.items():
-            print(f"\t{k}: {v}")
-        print("\n")
+        lines.extend([f"Source {i}:\n", f"Text: {source_text}", "Metadata:"])
+        lines.extend(f"\t{k}: {v}" for k, v in metadata.items())
+        lines.append("\n")
+    print("\n".join(lines))